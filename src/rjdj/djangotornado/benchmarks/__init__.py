@@ -0,0 +1,31 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+
+def configure_settings(**options):
+    """Configure Django with minimal settings unless already done"""
+    from django.conf import settings
+    if not settings.configured:
+        options.setdefault("DEBUG", False)
+        settings.configure(**options)
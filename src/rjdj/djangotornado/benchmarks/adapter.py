@@ -0,0 +1,111 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmark of the Tornado --> Django request adapter
+
+Compares the cost of `DjangoRequest` with the way requests were adapted
+before (full WSGI environment up front, cookies parsed and copied on
+every request)::
+
+    python -m rjdj.djangotornado.benchmarks.adapter [iterations]
+"""
+
+__docformat__ = "reStructuredText"
+
+import sys
+import Cookie
+import timeit
+
+from rjdj.djangotornado.benchmarks import configure_settings
+
+
+def make_request():
+    from tornado.httpserver import HTTPRequest
+    from tornado.httputil import HTTPHeaders
+
+    headers = HTTPHeaders()
+    headers.add("Host", "example.com")
+    headers.add("User-Agent", "Mozilla/5.0 (X11; Linux x86_64; rv:24.0)")
+    headers.add("Accept", "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8")
+    headers.add("Accept-Language", "en-US,en;q=0.5")
+    headers.add("Referer", "http://example.com/")
+    headers.add("Cookie", "sessionid=6f5902ac237024bdd0c176cb93063dc4; "
+                          "csrftoken=0123456789abcdef; lang=en")
+    return HTTPRequest("GET", "/articles/2011/?page=2&sort=date",
+                       headers=headers)
+
+
+def legacy_request(tornado_request):
+    """The adapter as it used to be"""
+    from tornado.wsgi import WSGIContainer
+    from django.core.handlers.wsgi import WSGIRequest
+
+    request = WSGIRequest(WSGIContainer.environ(tornado_request))
+    cookies = Cookie.BaseCookie()
+    header = tornado_request.headers.get("Cookie", "")
+    if header:
+        cookies.load(str(header))
+    request._cookies = cookies
+    for k, v in cookies.items():
+        request.COOKIES[k] = v.value
+    return request
+
+
+def lean_request(tornado_request):
+    from rjdj.djangotornado.handlers import DjangoRequest
+    return DjangoRequest(tornado_request)
+
+
+SCENARIOS = (
+    ("construct", lambda r: None),
+    ("cookies", lambda r: r.COOKIES.get("sessionid")),
+    ("get+cookies+meta", lambda r: (r.GET.get("page"),
+                                    r.COOKIES.get("sessionid"),
+                                    r.META.get("HTTP_HOST"))),
+)
+
+
+def measure(adapter, access, iterations):
+    """Microseconds per request for building and using one request"""
+    def run():
+        access(adapter(make_request()))
+    baseline = timeit.timeit(make_request, number=iterations)
+    total = timeit.timeit(run, number=iterations)
+    return (total - baseline) / iterations * 1e6
+
+
+def main(argv=None):
+    argv = argv if argv is not None else sys.argv[1:]
+    iterations = int(argv[0]) if argv else 20000
+    configure_settings()
+
+    print "%-20s %12s %12s %8s" % ("scenario", "before (us)", "after (us)",
+                                   "speedup")
+    for name, access in SCENARIOS:
+        before = measure(legacy_request, access, iterations)
+        after = measure(lean_request, access, iterations)
+        print "%-20s %12.1f %12.1f %7.1fx" % (name, before, after,
+                                              before / after)
+
+
+if __name__ == "__main__":
+    main()
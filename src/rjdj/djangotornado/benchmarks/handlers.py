@@ -0,0 +1,293 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+
+# -*- coding: utf-8 -*-
+
+"""Throughput and latency of the Django handler modes
+
+Starts a `rjdj.djangotornado.testing.TestServer` with the same views
+behind `SynchronousDjangoHandler` (``sync``), `DjangoHandler`
+(``async``) and the Django application behind Tornado's
+``FallbackHandler`` (``fallback``), and drives every mode and scenario
+with a number of client threads using keep-alive connections::
+
+    python -m rjdj.djangotornado.benchmarks.handlers \\
+        [--concurrency 10] [--duration 5] [--modes sync,async] \\
+        [--scenarios cpu,sleep] [--output run.json] [--compare old.json]
+
+The results (requests, errors, req/s and p50/p99/p999 latency in
+milliseconds per mode and scenario) are written as JSON; ``--compare``
+prints the change against the results of an earlier run.
+"""
+
+__docformat__ = "reStructuredText"
+
+import sys
+import json
+import time
+import socket
+import hashlib
+import httplib
+import optparse
+import threading
+
+from rjdj.djangotornado.benchmarks import configure_settings
+
+
+MODES = ("sync", "async", "fallback")
+
+LARGE_RESPONSE_SIZE = 1024 * 1024
+UPLOAD_SIZE = 256 * 1024
+SLEEP = 0.01
+BOUNDARY = "----djangotornadobenchmark"
+
+
+def cpu_view(request, *args):
+    from django.http import HttpResponse
+    digest = "x"
+    for i in range(2000):
+        digest = hashlib.sha1(digest).hexdigest()
+    return HttpResponse(digest, content_type="text/plain")
+
+def sleep_view(request, *args):
+    from django.http import HttpResponse
+    time.sleep(SLEEP)
+    return HttpResponse("slept", content_type="text/plain")
+
+_large_body = "x" * LARGE_RESPONSE_SIZE
+
+def large_view(request, *args):
+    from django.http import HttpResponse
+    return HttpResponse(_large_body, content_type="application/octet-stream")
+
+def upload_view(request, *args):
+    from django.http import HttpResponse
+    size = sum(f.size for f in request.FILES.values())
+    return HttpResponse(str(size), content_type="text/plain")
+
+
+def upload_body():
+    data = "x" * UPLOAD_SIZE
+    body = "\r\n".join([
+        "--" + BOUNDARY,
+        'Content-Disposition: form-data; name="file"; filename="data.bin"',
+        "Content-Type: application/octet-stream",
+        "",
+        data,
+        "--" + BOUNDARY + "--",
+        ""])
+    headers = {"Content-Type": "multipart/form-data; boundary=" + BOUNDARY}
+    return body, headers
+
+
+# name: (view, method, request body and headers)
+SCENARIOS = (
+    ("cpu", cpu_view, "GET", None),
+    ("sleep", sleep_view, "GET", None),
+    ("large", large_view, "GET", None),
+    ("upload", upload_view, "POST", upload_body),
+)
+
+# Django URLconf of the fallback mode
+urlpatterns = None
+
+def django_urlpatterns():
+    try:
+        from django.conf.urls import patterns, url
+    except ImportError:
+        from django.conf.urls.defaults import patterns, url
+    return patterns("", *[url(r"^fallback/%s$" % name, view)
+                          for name, view, method, body in SCENARIOS])
+
+def tornado_handlers():
+    """Route /<mode>/<scenario> to the views"""
+    from django.core.handlers.wsgi import WSGIHandler
+    from tornado.web import FallbackHandler
+    from rjdj.djangotornado.handlers import (SynchronousDjangoHandler,
+                                             DjangoHandler,
+                                             DjangoWSGIContainer)
+    from rjdj.djangotornado import patches
+
+    FallbackHandler.prepare = patches.patch_prepare(FallbackHandler.prepare)
+    handlers = []
+    for name, view, method, body in SCENARIOS:
+        handlers.append((r"/sync/%s" % name, SynchronousDjangoHandler,
+                         dict(django_view=view)))
+        handlers.append((r"/async/%s" % name, DjangoHandler,
+                         dict(django_view=view)))
+    handlers.append((r"/fallback/.*", FallbackHandler,
+                     dict(fallback=DjangoWSGIContainer(WSGIHandler()))))
+    return handlers
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+def summarize(latencies, errors, seconds):
+    latencies = sorted(latencies)
+    def ms(value):
+        return None if value is None else round(value * 1000.0, 3)
+    return {"requests": len(latencies),
+            "errors": errors,
+            "seconds": round(seconds, 3),
+            "rps": round(len(latencies) / seconds, 1) if seconds else 0.0,
+            "p50": ms(percentile(latencies, 0.5)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "p999": ms(percentile(latencies, 0.999))}
+
+
+class LoadGenerator(object):
+    """Sends requests from ``concurrency`` threads for ``duration`` seconds
+
+    Every thread keeps one HTTP/1.1 connection open and reconnects after
+    errors. Only successful requests are counted in the latencies.
+    """
+
+    def __init__(self, host, port, concurrency=10, duration=5.0,
+                 timeout=30.0):
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.duration = duration
+        self.timeout = timeout
+
+    def run(self, method, path, body=None, headers=None):
+        results = []
+        deadline = time.time() + self.duration
+        threads = [threading.Thread(target=self._client,
+                                    args=(method, path, body, headers or {},
+                                          deadline, results))
+                   for i in range(self.concurrency)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.time() - start
+        latencies = []
+        errors = 0
+        for thread_latencies, thread_errors in results:
+            latencies.extend(thread_latencies)
+            errors += thread_errors
+        return summarize(latencies, errors, seconds)
+
+    def _client(self, method, path, body, headers, deadline, results):
+        latencies = []
+        errors = 0
+        connection = None
+        while time.time() < deadline:
+            if connection is None:
+                connection = httplib.HTTPConnection(self.host, self.port,
+                                                    timeout=self.timeout)
+            start = time.time()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                response.read()
+            except (socket.error, httplib.HTTPException):
+                errors += 1
+                connection.close()
+                connection = None
+                continue
+            if response.status == 200:
+                latencies.append(time.time() - start)
+            else:
+                errors += 1
+            if response.will_close:
+                connection.close()
+                connection = None
+        if connection is not None:
+            connection.close()
+        results.append((latencies, errors))
+
+
+def compare(old, new):
+    """Print req/s and p99 of new relative to old results"""
+    print >> sys.stderr, "%-16s %10s %8s %10s %8s" % (
+        "benchmark", "req/s", "change", "p99 (ms)", "change")
+    for key in sorted(new):
+        result = new[key]
+        before = old.get(key)
+        def change(field):
+            if not before or not before.get(field) or result[field] is None:
+                return "-"
+            return "%+.1f%%" % ((result[field] / before[field] - 1) * 100)
+        print >> sys.stderr, "%-16s %10.1f %8s %10s %8s" % (
+            key, result["rps"], change("rps"), result["p99"], change("p99"))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--concurrency", type="int", default=10)
+    parser.add_option("--duration", type="float", default=5.0,
+                      help="seconds per mode and scenario")
+    parser.add_option("--modes", default=",".join(MODES))
+    parser.add_option("--scenarios",
+                      default=",".join(s[0] for s in SCENARIOS))
+    parser.add_option("--port", type="int", default=None,
+                      help="default: an ephemeral port")
+    parser.add_option("--output", default=None,
+                      help="write the JSON results to this file")
+    parser.add_option("--compare", default=None,
+                      help="JSON results of an earlier run")
+    options, args = parser.parse_args(argv)
+
+    global urlpatterns
+    # No middleware: the default CSRF middleware would reject the uploads
+    # of the fallback mode only
+    configure_settings(ROOT_URLCONF=__name__, MIDDLEWARE_CLASSES=(),
+                       TORNADO_WORKER_POOL_SIZE=options.concurrency)
+    urlpatterns = django_urlpatterns()
+
+    from rjdj.djangotornado.testing import TestServer
+    server = TestServer(tornado_handlers(), port=options.port)
+    server.run()
+
+    scenarios = dict((s[0], s) for s in SCENARIOS)
+    generator = LoadGenerator(server.address, server.port,
+                              concurrency=options.concurrency,
+                              duration=options.duration)
+    results = {}
+    for mode in options.modes.split(","):
+        for name in options.scenarios.split(","):
+            name, view, method, body = scenarios[name]
+            body, headers = body() if body else (None, None)
+            results["%s/%s" % (mode, name)] = generator.run(
+                method, "/%s/%s" % (mode, name), body, headers)
+
+    server._stop()
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print output
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
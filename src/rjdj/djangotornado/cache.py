@@ -0,0 +1,309 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+
+
+class LRUCache(object):
+    """Dictionary with expiring entries, limited by the total size
+
+    Every entry is stored with its size in bytes; once ``max_size`` is
+    exceeded the least recently used entries are evicted.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        """Return the value for key, None if missing or expired"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires = entry
+            if expires is not None and expires <= time.time():
+                self.size -= size
+                self.misses += 1
+                return None
+            # Re-insert to mark the entry as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size, ttl=None):
+        if size > self.max_size:
+            return
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_size:
+                evicted_key, (evicted, evicted_size, e) = \
+                    self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "size": self.size,
+                    "max_size": self.max_size,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+class CachedResponse(object):
+    """Status, headers and body of a response in the cache"""
+
+    __slots__ = ("status_code", "headers", "body", "size")
+
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers)
+
+
+class CachePolicy(object):
+    """Caching rules of a route
+
+    Set with the ``cache`` URLSpec kwarg, either as the TTL in seconds,
+    as True for the TTL of the Django setting
+    ``TORNADO_RESPONSE_CACHE_TTL`` (default 60 seconds) or as a dict with the keys ``ttl``, ``vary`` (request headers which
+    select different responses) and ``vary_cookies`` (cookie names
+    which do the same).  ``Vary`` headers of the responses are taken
+    into account as well; ``Vary: Cookie`` makes the whole Cookie
+    header part of the key.
+    """
+
+    def __init__(self, ttl, vary=(), vary_cookies=()):
+        self.ttl = ttl
+        self.vary = tuple(header.lower() for header in vary)
+        self.vary_cookies = tuple(vary_cookies)
+
+    @classmethod
+    def from_option(cls, option):
+        """Create a policy from the ``cache`` URLSpec kwarg"""
+        if not option:
+            return None
+        if isinstance(option, cls):
+            return option
+        if option is True:
+            return cls(getattr(settings, "TORNADO_RESPONSE_CACHE_TTL", 60))
+        if isinstance(option, dict):
+            return cls(**option)
+        return cls(option)
+
+    def is_cacheable(self, status_code, headers):
+        """Only successful, public responses without cookies are cached"""
+        if status_code != 200:
+            return False
+        for name, value in headers:
+            name = name.lower()
+            if name == "set-cookie":
+                return False
+            if name == "cache-control" and \
+               ("private" in value or "no-store" in value or
+                "no-cache" in value):
+                return False
+        return True
+
+    def key(self, handler, vary):
+        """Build the cache key of the request of a handler"""
+        request = handler.request
+        headers = request.headers
+        key = [request.host, request.uri]
+        for header in self.vary + vary:
+            key.append(headers.get(header))
+        if self.vary_cookies:
+            cookies = handler.cookies
+            for name in self.vary_cookies:
+                morsel = cookies.get(name)
+                key.append(morsel.value if morsel is not None else None)
+        return tuple(key)
+
+
+def response_vary(headers):
+    """Return the lower-cased header names of the Vary response headers"""
+    vary = []
+    for name, value in headers:
+        if name.lower() == "vary":
+            vary.extend(header.strip().lower() for header in value.split(","))
+    return tuple(vary)
+
+
+class ResponseCache(object):
+    """Cache of rendered Django responses, served on the IOLoop
+
+    The Vary headers of the responses of a URL are remembered separately
+    so lookups can build the full key before the view ever ran.
+    """
+
+    def __init__(self, max_size):
+        self.entries = LRUCache(max_size)
+        self.hits = self.misses = 0
+
+    def lookup(self, policy, handler):
+        """Return the `CachedResponse` for the request of handler"""
+        request = handler.request
+        vary = self.entries.get(("vary", request.host, request.uri))
+        cached = None
+        if vary is not None:
+            cached = self.entries.get(policy.key(handler, vary))
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cached
+
+    def store(self, policy, handler, status_code, headers, body):
+        if not policy.is_cacheable(status_code, headers):
+            return
+        request = handler.request
+        vary = response_vary(headers)
+        self.entries.set(("vary", request.host, request.uri), vary,
+                         len(request.uri) + sum(map(len, vary)), policy.ttl)
+        cached = CachedResponse(status_code, headers, body)
+        self.entries.set(policy.key(handler, vary), cached, cached.size,
+                         policy.ttl)
+
+    def stats(self):
+        stats = self.entries.stats()
+        stats.update(hits=self.hits, misses=self.misses)
+        return stats
+
+
+class SingleFlight(object):
+    """Identical requests in flight
+
+    The first request with a key leads, later ones follow until the
+    leader lands and hands them its response.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = Lock()
+
+    def join(self, key, handler):
+        """Return True if handler leads, False if it follows a request
+        with the same key"""
+        with self._lock:
+            followers = self._flights.get(key)
+            if followers is None:
+                self._flights[key] = []
+                return True
+            followers.append(handler)
+            return False
+
+    def leave(self, key, handler):
+        """Stop following, e.g. on disconnect"""
+        with self._lock:
+            followers = self._flights.get(key)
+            if followers is not None and handler in followers:
+                followers.remove(handler)
+
+    def land(self, key):
+        """End the flight of key; returns its followers"""
+        with self._lock:
+            return self._flights.pop(key, [])
+
+    def __len__(self):
+        return len(self._flights)
+
+
+_cache = None
+_cache_lock = Lock()
+
+def get_response_cache():
+    """Return the shared response cache, created on first use
+
+    Its size in bytes is set with the Django setting
+    ``TORNADO_RESPONSE_CACHE_SIZE`` (default 16 MB).
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(getattr(
+                    settings, "TORNADO_RESPONSE_CACHE_SIZE", 16 * 1024 * 1024))
+    return _cache
+
+
+_session_cache = None
+_session_cache_lock = Lock()
+
+def get_session_cache():
+    """Return the shared session cache, created on first use
+
+    It holds up to ``TORNADO_SESSION_CACHE_SIZE`` sessions (default
+    10000).
+    """
+    global _session_cache
+    if _session_cache is None:
+        with _session_cache_lock:
+            if _session_cache is None:
+                _session_cache = LRUCache(getattr(
+                    settings, "TORNADO_SESSION_CACHE_SIZE", 10000))
+    return _session_cache
+
+def session_cache_stats():
+    """Stats of the session cache, None if it is not in use"""
+    if _session_cache is None:
+        return None
+    return _session_cache.stats()
+
+
+_single_flight = SingleFlight()
+
+def get_single_flight():
+    """Return the requests in flight of routes with ``coalesce``"""
+    return _single_flight
@@ -0,0 +1,184 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import sys
+import types
+import inspect
+import functools
+
+from threading import Lock
+
+from rjdj.djangotornado.pool import add_callback, current_io_loop
+
+
+class _Future(object):
+    """Minimal Future for Tornado versions without tornado.concurrent"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise Exception("Future is not done yet")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exception(self, exception):
+        self.set_exc_info((exception.__class__, exception, None))
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._set_done()
+
+    def _set_done(self):
+        with self._lock:
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+class _Return(Exception):
+    """Raise to return a value from a coroutine view"""
+
+    def __init__(self, value=None):
+        super(_Return, self).__init__()
+        self.value = value
+
+
+class _Runner(object):
+    """Drives a generator which yields Futures on the IOLoop it was
+    started on"""
+
+    def __init__(self, generator, future):
+        self.generator = generator
+        self.future = future
+        self.io_loop = current_io_loop()
+
+    def run(self, value=None, exc_info=None):
+        try:
+            if exc_info is not None:
+                yielded = self.generator.throw(*exc_info)
+            else:
+                yielded = self.generator.send(value)
+        except StopIteration:
+            self._finish().set_result(None)
+            return
+        except Return, e:
+            self._finish().set_result(e.value)
+            return
+        except Exception:
+            self._finish().set_exc_info(sys.exc_info())
+            return
+        if not is_future(yielded):
+            error = TypeError("Coroutine views can only yield Futures, "
+                              "not %r" % (yielded,))
+            self.run(exc_info=(TypeError, error, None))
+            return
+        yielded.add_done_callback(self._resume)
+
+    def _finish(self):
+        """Drop the references to generator and future, which would form
+        a cycle with the traceback of a failed coroutine"""
+        future = self.future
+        self.generator = self.future = None
+        return future
+
+    def _resume(self, future):
+        add_callback(functools.partial(self._run_with_result, future),
+                     self.io_loop)
+
+    def _run_with_result(self, future):
+        try:
+            value = future.result()
+        except Exception:
+            self.run(exc_info=sys.exc_info())
+        else:
+            self.run(value)
+
+
+def _coroutine(func):
+    """Turns a generator function yielding Futures into a function
+    returning a Future"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        future = Future()
+        try:
+            result = func(*args, **kwargs)
+        except Return, e:
+            future.set_result(e.value)
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+        else:
+            if isinstance(result, types.GeneratorType):
+                _Runner(result, future).run()
+            else:
+                future.set_result(result)
+        return future
+    return wrapper
+
+
+try:
+    from tornado.concurrent import Future
+except ImportError:
+    Future = _Future
+
+try:
+    from tornado.gen import coroutine, Return
+except ImportError:
+    coroutine, Return = _coroutine, _Return
+
+
+def is_future(obj):
+    """True for objects implementing the Future interface (Tornado's and
+    concurrent.futures' Futures)"""
+    return hasattr(obj, "add_done_callback") and hasattr(obj, "result")
+
+def is_coroutine_function(func):
+    """True for generator functions, which are run as coroutines"""
+    return inspect.isgeneratorfunction(func)
@@ -0,0 +1,266 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import time
+import logging
+
+from threading import Condition, Lock, local
+
+from django.conf import settings
+from django.core import signals
+
+
+logger = logging.getLogger()
+
+# SQLite connections must not be shared between threads
+POOLED_VENDORS = ("postgresql", "mysql", "oracle")
+
+
+class ConnectionPoolTimeout(Exception):
+    """Raised if no connection slot became free in time"""
+
+
+class ConnectionPool(object):
+    """Keeps the database connections of one alias open between requests
+
+    A thread checks out a slot before handling a request and gets an
+    idle connection if there is one (otherwise Django connects on first
+    use).  At most ``max_size`` slots are handed out, further threads
+    wait up to ``timeout`` seconds for a slot.  Connections that have
+    been idle for more than ``check_interval`` seconds are checked with
+    ``SELECT 1`` before they are handed out again.
+    """
+
+    def __init__(self, alias, max_size, check_interval=30.0, timeout=None):
+        if max_size < 1:
+            raise ValueError("Connection pool needs at least one connection")
+        self.alias = alias
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self._idle = []
+        self._in_use = 0
+        self._condition = Condition(Lock())
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def checkout(self, take_idle=True):
+        """Reserve a slot and return an idle connection or None
+
+        Raises `ConnectionPoolTimeout` if no slot is given back within
+        ``timeout`` seconds.
+        """
+        with self._condition:
+            if self._in_use >= self.max_size:
+                started = time.time()
+                while self._in_use >= self.max_size:
+                    if self.timeout is None:
+                        self._condition.wait()
+                        continue
+                    remaining = started + self.timeout - time.time()
+                    if remaining <= 0:
+                        raise ConnectionPoolTimeout(
+                            "No free connection for %r after %.1fs" %
+                            (self.alias, self.timeout))
+                    self._condition.wait(remaining)
+                waited = time.time() - started
+                self._waits += 1
+                self._wait_time += waited
+                self._max_wait_time = max(self._max_wait_time, waited)
+            self._in_use += 1
+            if not take_idle or not self._idle:
+                return None
+            connection, released = self._idle.pop()
+        if time.time() - released > self.check_interval and \
+           not self.is_usable(connection):
+            self._close(connection)
+            return None
+        return connection
+
+    def checkin(self, connection):
+        """Give back the slot and keep the connection (may be None)"""
+        if connection is not None:
+            try:
+                connection.rollback()
+            except Exception:
+                logger.warning("Discarding broken database connection",
+                               exc_info=True)
+                self._close(connection)
+                connection = None
+        with self._condition:
+            self._in_use -= 1
+            if connection is not None:
+                self._idle.append((connection, time.time()))
+            self._condition.notify()
+
+    def is_usable(self, connection):
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+        except Exception:
+            return False
+        return True
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """Close all idle connections"""
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for connection, released in idle:
+            self._close(connection)
+
+    def stats(self):
+        with self._condition:
+            return {"in_use": self._in_use,
+                    "idle": len(self._idle),
+                    "max_size": self.max_size,
+                    "waits": self._waits,
+                    "wait_time": self._wait_time,
+                    "max_wait_time": self._max_wait_time}
+
+
+class ConnectionPools(object):
+    """Binds pooled connections to the Django connections of a thread"""
+
+    def __init__(self, pools):
+        self.pools = pools
+        self._local = local()
+
+    def acquire(self):
+        """Hand pooled connections to the current thread
+
+        Raises `ConnectionPoolTimeout` if a pool has no free slot.
+        """
+        if getattr(self._local, "acquired", False):
+            return
+        from django.db import connections
+        acquired = []
+        try:
+            for alias, pool in self.pools.iteritems():
+                wrapper = connections[alias]
+                # A thread may still have a connection Django opened
+                # outside of a request; the pool adopts it on release.
+                connection = pool.checkout(
+                    take_idle=wrapper.connection is None)
+                acquired.append(alias)
+                if connection is not None:
+                    wrapper.connection = connection
+        except ConnectionPoolTimeout:
+            for alias in acquired:
+                wrapper = connections[alias]
+                connection, wrapper.connection = wrapper.connection, None
+                self.pools[alias].checkin(connection)
+            raise
+        self._local.acquired = True
+
+    def release(self, **kwargs):
+        """Take the connections of the current thread back into the pools
+
+        Connected to ``request_finished`` instead of Django's
+        ``close_connection``.  Threads which did not acquire pooled
+        connections (e.g. the IOLoop thread) close their connections as
+        Django does.
+        """
+        if not getattr(self._local, "acquired", False):
+            from django.db import close_connection
+            close_connection()
+            return
+        from django.db import connections
+        for alias, pool in self.pools.iteritems():
+            wrapper = connections[alias]
+            connection, wrapper.connection = wrapper.connection, None
+            pool.checkin(connection)
+        self._local.acquired = False
+
+    def stats(self):
+        return dict((alias, pool.stats())
+                    for alias, pool in self.pools.iteritems())
+
+
+_pools = None
+_pools_lock = Lock()
+
+def get_connection_pools():
+    """Return the shared connection pools, None if pooling is disabled
+
+    Pooling is enabled with the Django setting ``TORNADO_DB_POOL``
+    (default False) for all PostgreSQL, MySQL and Oracle databases.
+    Each pool holds ``TORNADO_DB_POOL_SIZE`` connections (default: the
+    maximum number of worker threads); workers wait at most
+    ``TORNADO_DB_POOL_TIMEOUT`` seconds (default 10) for one.
+    ``TORNADO_DB_POOL_CHECK_INTERVAL`` (default 30 seconds) sets the
+    idle time after which connections are checked before use.  Only
+    worker threads use pooled connections, ``request_finished`` still
+    closes the connections of other threads.
+    """
+    global _pools
+    if _pools is None:
+        with _pools_lock:
+            if _pools is None:
+                _pools = _create_pools()
+    return _pools or None
+
+def _create_pools():
+    if not getattr(settings, "TORNADO_DB_POOL", False):
+        return False
+    from django.db import connections, close_connection
+    workers = getattr(settings, "TORNADO_WORKER_POOL_SIZE", 10)
+    workers = getattr(settings, "TORNADO_WORKER_POOL_MAX_SIZE", workers)
+    max_size = getattr(settings, "TORNADO_DB_POOL_SIZE", workers)
+    check_interval = getattr(settings, "TORNADO_DB_POOL_CHECK_INTERVAL", 30.0)
+    timeout = getattr(settings, "TORNADO_DB_POOL_TIMEOUT", 10.0)
+    pools = {}
+    for alias in connections:
+        if connections[alias].vendor in POOLED_VENDORS:
+            pools[alias] = ConnectionPool(alias, max_size, check_interval,
+                                          timeout)
+    if not pools:
+        return False
+    pools = ConnectionPools(pools)
+    signals.request_finished.disconnect(close_connection)
+    signals.request_finished.connect(pools.release, weak=False)
+    return pools
+
+def acquire_connections():
+    """Hand pooled connections to the current thread (if pooling is on)
+
+    Only called in worker threads, as it may block; raises
+    `ConnectionPoolTimeout` if no connection became free in time.
+    """
+    pools = get_connection_pools()
+    if pools is not None:
+        pools.acquire()
+
+def release_connections():
+    """Give the connections of the current thread back to the pools"""
+    pools = get_connection_pools()
+    if pools is not None:
+        pools.release()
@@ -0,0 +1,282 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import json
+import time
+import logging
+import functools
+
+from django.http import HttpResponse
+
+from rjdj.djangotornado.pool import add_callback, current_io_loop
+from rjdj.djangotornado.coroutines import Future, is_future
+from rjdj.djangotornado.hub import get_hub
+from rjdj.djangotornado.handlers import (DjangoHandler,
+                                         SynchronousDjangoHandler,
+                                         request_io_loop)
+
+
+logger = logging.getLogger()
+
+
+class Event(object):
+    """A Server-Sent Event
+
+    ``data`` may be a string, unicode or anything JSON can encode;
+    multi-line data is sent as several ``data:`` lines.
+    """
+
+    def __init__(self, data, id=None, event=None, retry=None):
+        self.data = data
+        self.id = id
+        self.event = event
+        self.retry = retry
+
+    def encode(self):
+        data = self.data
+        if not isinstance(data, basestring):
+            data = json.dumps(data)
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        lines = []
+        if self.id is not None:
+            lines.append("id: %s" % self.id)
+        if self.event is not None:
+            lines.append("event: %s" % self.event)
+        if self.retry is not None:
+            lines.append("retry: %d" % self.retry)
+        lines.extend("data: %s" % line for line in data.split("\n"))
+        return "\n".join(lines) + "\n\n"
+
+    def __repr__(self):
+        return "<Event %r id=%r>" % (self.data, self.id)
+
+
+def encode_event(event):
+    """Encode an `Event`, a list of events or plain data"""
+    if isinstance(event, (list, tuple)):
+        return "".join(encode_event(e) for e in event)
+    if not isinstance(event, Event):
+        event = Event(event)
+    return event.encode()
+
+def last_event_id(request):
+    """The ``Last-Event-ID`` a reconnecting client sent, or None
+
+    The ``lastEventId`` query argument is accepted as well, for clients
+    which cannot set headers.
+    """
+    return (request.META.get("HTTP_LAST_EVENT_ID") or
+            request.GET.get("lastEventId") or None)
+
+
+class EventStreamResponse(HttpResponse):
+    """Response streaming the events of an iterable
+
+    The iterable yields `Event` objects, lists of them or plain data; it
+    may block (it runs in the worker pool) or yield Futures of events.
+    ``retry`` tells clients how many milliseconds to wait before they
+    reconnect.
+    """
+
+    streaming = True
+
+    def __init__(self, events, retry=None, status=200):
+        super(EventStreamResponse, self).__init__(
+            "", content_type="text/event-stream", status=status)
+        self["Cache-Control"] = "no-cache"
+        self.events = events
+        self.retry = retry
+
+
+class ChannelEvents(object):
+    """Iterable of the messages published on a channel of the hub
+
+    Every message becomes an event with its sequence number as id, so
+    clients resume after the last event they got.  Waiting for messages
+    does not hold a thread: the iterator yields Futures.
+    """
+
+    nonblocking = True
+
+    def __init__(self, channel, since=None, hub=None):
+        self.channel = channel
+        self.hub = hub or get_hub()
+        try:
+            self.since = int(since)
+        except (TypeError, ValueError):
+            self.since = self.hub.last_seq(channel)
+        self._waiter = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        future = Future()
+        self._subscribe(future)
+        return future
+
+    def _subscribe(self, future):
+        self._waiter = self.hub.subscribe(
+            self.channel, self.since,
+            functools.partial(self._deliver, future), current_io_loop())
+
+    def _deliver(self, future, messages):
+        self._waiter = None
+        if not messages:
+            # Nothing to send yet, keep waiting
+            self._subscribe(future)
+            return
+        self.since = messages[-1][0]
+        future.set_result([Event(data, id=seq) for seq, data in messages])
+
+    def close(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            self.hub.unsubscribe(waiter)
+
+def subscribe(channel, request=None, hub=None):
+    """Stream a channel of the hub, resuming after the ``Last-Event-ID``
+    of request"""
+    since = last_event_id(request) if request is not None else None
+    return EventStreamResponse(ChannelEvents(channel, since, hub))
+
+
+class EventStreamHandler(DjangoHandler):
+    """Handler streaming ``text/event-stream`` responses
+
+    Views return an `EventStreamResponse`, or just an iterable of events
+    (a generator, `ChannelEvents`), which is wrapped into one.  Every
+    event is flushed as soon as it is there; while the stream waits for
+    the next one a comment is sent every ``heartbeat`` seconds, so
+    proxies keep the connection open and dead clients are noticed.
+    Other responses are sent as by `DjangoHandler`.
+
+    Views themselves must not be generator functions, these run as
+    coroutines; they return the generator instead.
+    """
+
+    def initialize(self, django_view, heartbeat=15.0, **kwargs):
+        super(EventStreamHandler, self).initialize(django_view, **kwargs)
+        self.heartbeat = heartbeat
+        self._heartbeat_timeout = None
+        self._last_write = None
+        self._waiting = False
+        self._events = None
+
+    def _process_response(self, request, response):
+        if not isinstance(response, (HttpResponse, basestring)) and \
+           hasattr(response, "__iter__"):
+            response = EventStreamResponse(response)
+        return super(EventStreamHandler, self)._process_response(request,
+                                                                 response)
+
+    def stream_response(self, response):
+        if not isinstance(response, EventStreamResponse):
+            super(EventStreamHandler, self).stream_response(response)
+            return
+        self._auto_finish = False
+        self._convert_headers(response)
+        self._events = chunks = iter(response.events)
+        if response.retry is not None:
+            self.write("retry: %d\n\n" % response.retry)
+        self._last_write = time.time()
+        self._schedule_heartbeat()
+        # Send the headers right away, the first event may take a while
+        self._flush(functools.partial(self._stream_next, chunks))
+
+    def _stream_next(self, chunks):
+        self._waiting = True
+        super(EventStreamHandler, self)._stream_next(chunks)
+
+    def _next_chunk(self, chunks, callback):
+        if getattr(chunks, "nonblocking", False):
+            SynchronousDjangoHandler._next_chunk(self, chunks, callback)
+        else:
+            super(EventStreamHandler, self)._next_chunk(chunks, callback)
+
+    def _write_chunk(self, chunks, chunk):
+        if chunks is not self._events:
+            super(EventStreamHandler, self)._write_chunk(chunks, chunk)
+            return
+        if is_future(chunk):
+            io_loop = request_io_loop(self.request)
+            callback = self.async_callback(self._on_event_future, chunks)
+            chunk.add_done_callback(
+                lambda future: add_callback(
+                    functools.partial(callback, future), io_loop))
+            return
+        if chunk is not None and not isinstance(chunk, Exception):
+            chunk = encode_event(chunk)
+            self._waiting = False
+            self._last_write = time.time()
+        super(EventStreamHandler, self)._write_chunk(chunks, chunk)
+
+    def _on_event_future(self, chunks, future):
+        try:
+            chunk = future.result()
+        except Exception, e:
+            logger.error("Exception while streaming events", exc_info=True)
+            chunk = e
+        self._write_chunk(chunks, chunk)
+
+    def _schedule_heartbeat(self):
+        if not self.heartbeat:
+            return
+        deadline = self._last_write + self.heartbeat
+        if deadline <= time.time():
+            # Still flushing the last event
+            deadline = time.time() + self.heartbeat
+        self._heartbeat_timeout = request_io_loop(self.request).add_timeout(
+            deadline, self.async_callback(self._on_heartbeat))
+
+    def _on_heartbeat(self):
+        self._heartbeat_timeout = None
+        if self._finished or self.request.connection.stream.closed():
+            return
+        now = time.time()
+        if self._waiting and now - self._last_write >= self.heartbeat:
+            # The previous flush is done once we wait for an event
+            self.write(":\n\n")
+            self.flush()
+            self._last_write = now
+        self._schedule_heartbeat()
+
+    def _stop_heartbeat(self):
+        if self._heartbeat_timeout is not None:
+            request_io_loop(self.request).remove_timeout(
+                self._heartbeat_timeout)
+            self._heartbeat_timeout = None
+
+    def on_connection_close(self):
+        super(EventStreamHandler, self).on_connection_close()
+        self._stop_heartbeat()
+        if getattr(self._events, "nonblocking", False):
+            # Blocking iterators may be running in a worker right now,
+            # they are closed once their next event arrives
+            self._events.close()
+
+    def finish(self, *args, **kwargs):
+        self._stop_heartbeat()
+        return super(EventStreamHandler, self).finish(*args, **kwargs)
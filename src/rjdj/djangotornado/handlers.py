@@ -22,10 +22,22 @@
 
 __docformat__ = "reStructuredText"
 
-from threading import Thread, Lock
+import sys
+import time
+import Cookie
+import urllib
+import logging
+import inspect
+import functools
+
+import tornado
+
+from io import BytesIO
+from threading import Lock, Event
 
 from cStringIO import StringIO
 
+from tornado import escape
 from tornado.web import RequestHandler, asynchronous
 from tornado.ioloop import IOLoop
 from tornado.wsgi import WSGIContainer
@@ -37,6 +49,7 @@ from django.core import signals
 from django.http import (HttpRequest,
                          QueryDict,
                          HttpResponse,
+                         parse_cookie,
 )
 
 try:
@@ -45,20 +58,100 @@ try:
 except ImportError:
     from django.http import MultiPartParser, MultiValueDict
 
+from rjdj.djangotornado.pool import (get_worker_pool, WorkerPoolFull,
+                                     add_callback)
+from rjdj.djangotornado.db import (acquire_connections, release_connections,
+                                   ConnectionPoolTimeout)
+from rjdj.djangotornado.cache import (CachePolicy, get_response_cache,
+                                     get_single_flight, response_vary)
+from rjdj.djangotornado.stats import get_stats
+from rjdj.djangotornado.profiling import get_profiler
+from rjdj.djangotornado.responses import (PreparedResponse, prepare_response,
+                                          is_not_modified, not_modified)
+from rjdj.djangotornado.coroutines import (coroutine, is_future,
+                                           is_coroutine_function)
+
+
+logger = logging.getLogger()
+
+# Tornado 2.0 cannot tell when a flush has reached the client
+_flush_takes_callback = "callback" in inspect.getargspec(RequestHandler.flush)[0]
+
+def wsgi_input(tornado_request):
+    """Request body as file-like object
+
+    Spooled request bodies (see `rjdj.djangotornado.server`) are passed
+    on as they are so they can be parsed incrementally.
+    """
+    body_file = getattr(tornado_request, "body_file", None)
+    if body_file is not None:
+        body_file.seek(0)
+        return body_file
+    return BytesIO(escape.utf8(tornado_request.body))
+
+def wsgi_environ(tornado_request):
+    """WSGI environment of a Tornado request"""
+    environ = WSGIContainer.environ(tornado_request)
+    environ["wsgi.input"] = wsgi_input(tornado_request)
+    return environ
+
+# Upload handler classes by FILE_UPLOAD_HANDLERS setting
+_upload_handler_classes = {}
+
+def request_io_loop(tornado_request):
+    """Return the IOLoop serving the Tornado request"""
+    connection = getattr(tornado_request, "connection", None)
+    stream = getattr(connection, "stream", None)
+    return getattr(stream, "io_loop", None) or IOLoop.instance()
+
+def is_streaming(response):
+    """True if the response content is an iterator that must not be joined"""
+    if getattr(response, "streaming", False):
+        return True
+    return (getattr(response, "_is_string", True) is False or
+            getattr(response, "_base_content_is_iter", False))
+
 
 class DjangoRequest(WSGIRequest):
-    """Tornado Request --> Django Request"""
+    """Tornado Request --> Django Request
+
+    META (and environ), COOKIES and GET are only built when they are
+    accessed for the first time. Unless a parsed cookie object is
+    passed in, COOKIES is parsed from the Cookie header on demand; like
+    in Django it maps cookie names to their values.
+
+    ``cancelled`` is a ``threading.Event`` which is set once the client
+    has disconnected or the deadline of the route has passed; long
+    running views may check it (or wait on it instead of sleeping).
+    """
 
     _tornado_request = None
     _cookies = None
+    _meta = None
+    _meta_complete = True
 
-    def __init__(self, tornado_request_type, cookies=None):
+    def __init__(self, tornado_request_type, cookies=None, cancelled=None):
         self._tornado_request = tornado_request_type
         self._cookies = cookies
-        environ = WSGIContainer.environ(tornado_request_type)
-        super(DjangoRequest,self).__init__(environ)
+        self.cancelled = cancelled or Event()
         self.tornado_to_django()
 
+        # WSGIRequest only needs a handful of keys, the full
+        # environment is added once META is accessed.
+        tr = tornado_request_type
+        environ = {
+            "REQUEST_METHOD": tr.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.unquote(tr.path),
+            "wsgi.input": wsgi_input(tr),
+        }
+        for header, key in (("Content-Type", "CONTENT_TYPE"),
+                            ("Content-Length", "CONTENT_LENGTH")):
+            if header in tr.headers:
+                environ[key] = tr.headers[header]
+        super(DjangoRequest,self).__init__(environ)
+        self._meta_complete = False
+
     def tornado_to_django(self):
         tr = self._tornado_request
         
@@ -67,14 +160,69 @@ class DjangoRequest(WSGIRequest):
         if tr.method not in ["GET","POST"]:
             raise ValueError("Method must be GET or POST")
 
-        if not self._cookies:
-            import Cookie
-            self._cookies = Cookie.BaseCookie()
-            cookies = tr.headers.get("Cookie","")
-            if cookies:
-                self._cookies.load(str(cookies))
-        for k,v in self._cookies.items():
-            self.COOKIES[k] = v.value
+    def _get_meta(self):
+        if not self._meta_complete:
+            self._meta_complete = True
+            for key, value in self._full_meta().iteritems():
+                self._meta.setdefault(key, value)
+        return self._meta
+
+    def _full_meta(self):
+        """The keys of the WSGI environment missing in __init__
+
+        Built from the Tornado request like `WSGIContainer.environ`, but
+        without copying the body and without popping headers.
+        """
+        tr = self._tornado_request
+        host, sep, port = tr.host.partition(":")
+        if not sep:
+            port = "443" if tr.protocol == "https" else "80"
+        meta = {
+            "QUERY_STRING": tr.query,
+            "REMOTE_ADDR": tr.remote_ip,
+            "SERVER_NAME": host,
+            "SERVER_PORT": str(int(port)),
+            "SERVER_PROTOCOL": tr.version,
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": tr.protocol,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": False,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        for header, value in tr.headers.iteritems():
+            if header not in ("Content-Type", "Content-Length"):
+                meta["HTTP_" + header.replace("-", "_").upper()] = value
+        return meta
+
+    def _set_meta(self, meta):
+        self._meta = meta
+
+    META = environ = property(_get_meta, _set_meta)
+
+    def _get_cookies(self):
+        if self._cookies is None:
+            self._cookies = parse_cookie(
+                str(self._tornado_request.headers.get("Cookie", "")))
+        elif isinstance(self._cookies, Cookie.BaseCookie):
+            self._cookies = parse_cookie(self._cookies)
+        return self._cookies
+
+    def _set_cookies(self, cookies):
+        self._cookies = cookies
+
+    COOKIES = property(_get_cookies, _set_cookies)
+
+    def _get_get(self):
+        if not hasattr(self, '_get'):
+            self._get = QueryDict(self._tornado_request.query,
+                                  encoding=self._encoding)
+        return self._get
+
+    def _set_get(self, get):
+        self._get = get
+
+    GET = property(_get_get, _set_get)
 
     def build_absolute_uri(self,location=None):
         uri = super(DjangoRequest,self).build_absolute_uri(location)
@@ -86,16 +234,26 @@ class DjangoRequest(WSGIRequest):
         else:
             self.META[key] = value
 
+    def _upload_handler_classes(self):
+        paths = tuple(settings.FILE_UPLOAD_HANDLERS)
+        classes = _upload_handler_classes.get(paths)
+        if classes is None:
+            classes = []
+            for handler in paths:
+                tmp = handler.split(".")
+                cls = tmp.pop()
+                module = ".".join(tmp)
+                imp = __import__(module, fromlist = [cls])
+                classes.append(getattr(imp, cls))
+            _upload_handler_classes[paths] = classes
+        return classes
+
+    def _initialize_handlers(self):
+        self._upload_handlers = [cls(self)
+                                 for cls in self._upload_handler_classes()]
+
     def _load_file_upload_handlers(self):
-        handlers = []
-        for handler in settings.FILE_UPLOAD_HANDLERS:
-            tmp = handler.split(".")
-            cls = tmp.pop()
-            module = ".".join(tmp)
-            imp = __import__(module, fromlist = [cls])
-            handlers.append(getattr(imp, cls)())
-            
-        return handlers
+        return [cls() for cls in self._upload_handler_classes()]
 
     @property
     def raw_get_data(self):
@@ -103,6 +261,15 @@ class DjangoRequest(WSGIRequest):
 
     @property
     def raw_post_data(self):
+        body_file = getattr(self._tornado_request, "body_file", None)
+        if body_file is not None:
+            # Only needed for non-multipart bodies, multipart data is
+            # parsed from the stream.
+            if self._read_started:
+                raise Exception("You cannot access raw_post_data after "
+                                "reading from request's data stream")
+            body_file.seek(0)
+            return body_file.read()
         return self._tornado_request.body
 
 
@@ -117,25 +284,73 @@ class CallableType:
 
 
 
+def noop_hook(hook):
+    """Mark a middleware hook as doing nothing
+
+    ``process_request`` hooks marked like this are assumed to always
+    return None, ``process_response`` hooks the response unchanged; the
+    `MiddlewarePipeline` leaves them out.
+    """
+    hook.djangotornado_noop = True
+    return hook
+
+def is_noop_hook(hook):
+    """True for hooks marked with `noop_hook`"""
+    return getattr(hook, "djangotornado_noop", False)
+
+
+class MiddlewarePipeline(object):
+    """Flat list of the request and response hooks of the middleware
+
+    Hooks marked with `noop_hook` are left out.
+    """
+
+    def __init__(self, request_hooks, response_hooks):
+        self.request_hooks = tuple(hook for hook in request_hooks
+                                   if not is_noop_hook(hook))
+        self.response_hooks = tuple(hook for hook in response_hooks
+                                    if not is_noop_hook(hook))
+
+    def process_request(self, request):
+        """Run the request hooks; returns the response of the first hook
+        which answers the request itself, otherwise None"""
+        for hook in self.request_hooks:
+            response = hook(request)
+            if response is not None:
+                return response
+        return None
+
+    def process_response(self, request, response):
+        for hook in self.response_hooks:
+            response = hook(request, response)
+        return response
+
+
 class MiddlewareProvider(BaseHandler):
     """Lazy loading Middleware"""
 
     initLock = Lock()
+    pipeline = None
 
     def __call__(self):
-        if self._request_middleware is None:
+        """Returns the `MiddlewarePipeline`, loaded on first use"""
+        if self.pipeline is None:
             self.initLock.acquire()
             try:
                 try:
                     # Check that middleware is still uninitialised.
-                    if self._request_middleware is None:
+                    if self.pipeline is None:
                         self.load_middleware()
+                        self.pipeline = MiddlewarePipeline(
+                            self._request_middleware,
+                            self._response_middleware)
                 except:
                     # Unload whatever middleware we got
                     self._request_middleware = None
                     raise
             finally:
                 self.initLock.release()
+        return self.pipeline
 
 
 middleware_provider = MiddlewareProvider()
@@ -146,6 +361,8 @@ class SynchronousDjangoHandler(RequestHandler):
 
     _view = None
     _handler_name = ""
+    _coroutine = False
+    _cache_policy = None
 
     def _get_stacktrace(self):
         import traceback
@@ -156,62 +373,296 @@ class SynchronousDjangoHandler(RequestHandler):
         return tb
 
     def initialize(self, django_view, **kwargs):
+        """Views which are generator functions or marked with
+        ``coroutine=True`` (e.g. decorated with ``gen.coroutine``) run
+        on the IOLoop; their Futures are resolved without a thread.
+
+        Requests not answered within ``deadline`` seconds get a 504.
+        """
+        if is_coroutine_function(django_view):
+            django_view = coroutine(django_view)
+            self._coroutine = True
+        else:
+            self._coroutine = kwargs.get("coroutine", False)
         self._view = CallableType(django_view)
         self._handler_name = kwargs.get("handler_name","synchronous_django_handler")
+        self.stats_name = kwargs.get("handler_name") or \
+                          getattr(django_view, "__name__", None)
+        self._cache_policy = CachePolicy.from_option(kwargs.get("cache"))
+        self._deadline = kwargs.get("deadline")
+        self._deadline_timeout = None
+        self._job = None
+        self._cancelled = Event()
 
     def prepare(self):
-        pass
+        """Serve cached responses without entering Django"""
+        if self._cache_policy is None or \
+           self.request.method not in ("GET", "HEAD"):
+            return
+        cached = get_response_cache().lookup(self._cache_policy, self)
+        if cached is not None:
+            prepared = PreparedResponse(cached.status_code, cached.headers,
+                                        cached.body)
+            if is_not_modified(self.request.headers,
+                               prepared.get_header("Etag"),
+                               prepared.get_header("Last-Modified")):
+                prepared = not_modified(prepared)
+            self.write_prepared(prepared)
+            self.finish()
             
-    def convert_response(self, response):
+    def _convert_headers(self, response):
+        """Copy status, headers and cookies; returns the headers"""
         self.set_status(response.status_code)
-        for k,v in response.items():
-            self.set_header(k.encode("utf-8"), v.encode("utf-8"))
-        if hasattr(response, "render"):
-            response.render()
-        self.write(response.content.encode("utf-8"))
+        headers = [(k.encode("utf-8"), v.encode("utf-8"))
+                   for k,v in response.items()]
+        for k,v in headers:
+            self.set_header(k, v)
+        if response.cookies:
+            self._convert_cookies(response.cookies)
+        return headers
+
+    def _convert_cookies(self, cookies):
+        """Hand the cookies set by the view or middleware to Tornado"""
+        if tornado.version_info >= (3, 0):
+            if not hasattr(self, "_new_cookie"):
+                self._new_cookie = Cookie.SimpleCookie()
+            self._new_cookie.update(cookies)
+        else:
+            if not hasattr(self, "_new_cookies"):
+                self._new_cookies = []
+            self._new_cookies.append(cookies)
+
+    def convert_response(self, response):
+        self.write_prepared(prepare_response(response, self.request))
+
+    def write_prepared(self, prepared):
+        """Write a `PreparedResponse` to the output buffer"""
+        self.set_status(prepared.status_code)
+        for k,v in prepared.headers:
+            self.set_header(k, v)
+        if prepared.cookies:
+            self._convert_cookies(prepared.cookies)
+        if prepared.body:
+            self.write(prepared.body)
+
+    def _store_in_cache(self, prepared):
+        if self._cache_policy is not None and \
+           self.request.method == "GET" and not prepared.cookies:
+            get_response_cache().store(self._cache_policy, self,
+                                       prepared.status_code, prepared.headers,
+                                       prepared.body)
+
+    def _start_deadline(self):
+        if self._deadline:
+            self._deadline_timeout = request_io_loop(self.request).add_timeout(
+                time.time() + self._deadline,
+                self.async_callback(self._on_deadline))
+
+    def _on_deadline(self):
+        """Answer with 504 and give up the worker of the view"""
+        self._deadline_timeout = None
+        if self._finished or self.request.connection.stream.closed():
+            return
+        self._cancel(abandon=True)
+        signals.request_finished.send(sender=middleware_provider.__class__)
+        self.send_error(504)
+
+    def _cancel(self, abandon=False):
+        """Flag the request as cancelled and drop its queued job"""
+        self._cancelled.set()
+        job, self._job = self._job, None
+        if job is None:
+            return
+        if abandon:
+            dropped = job.abandon()
+        else:
+            dropped = job.cancel()
+        if dropped and not abandon:
+            signals.request_finished.send(sender=middleware_provider.__class__)
+
+    def _clear_deadline(self):
+        if self._deadline_timeout is not None:
+            request_io_loop(self.request).remove_timeout(
+                self._deadline_timeout)
+            self._deadline_timeout = None
+
+    def on_connection_close(self):
+        self._clear_deadline()
+        self._cancel()
+
+    def finish(self, *args, **kwargs):
+        self._clear_deadline()
+        return super(SynchronousDjangoHandler, self).finish(*args, **kwargs)
 
     def return_response(self, response):
         """Response can either be a HttpResponse object or string"""
+        if self._finished:
+            # Answered by the deadline already
+            return
         if self.request.connection.stream.closed():
             signals.request_finished.send(sender=middleware_provider.__class__)
             return
         if isinstance(response, HttpResponse):
-            self.convert_response(response)
+            if is_streaming(response):
+                self.stream_response(response)
+                return
+            response = prepare_response(response, self.request)
+        if isinstance(response, PreparedResponse):
+            self._store_in_cache(response)
+            self.write_prepared(response)
         else:
             self.write(str(response).encode("utf-8"))
         signals.request_finished.send(sender=middleware_provider.__class__)
         self.finish()
 
+    def stream_response(self, response):
+        """Send iterator content chunk by chunk
+
+        Every chunk is flushed and the next one is not fetched before the
+        client has received the previous one.
+        """
+        self._auto_finish = False
+        self._convert_headers(response)
+        self._stream_next(iter(response))
+
+    def _stream_next(self, chunks):
+        self._next_chunk(chunks, functools.partial(self._write_chunk, chunks))
+
+    def _next_chunk(self, chunks, callback):
+        """Fetch the next chunk and pass it to the callback
+
+        The callback gets None once the iterator is exhausted and the
+        exception instance if the iterator failed.
+        """
+        try:
+            chunk = chunks.next()
+        except StopIteration:
+            chunk = None
+        except Exception, e:
+            logger.error("Exception while streaming response", exc_info=True)
+            chunk = e
+        callback(chunk)
+
+    def _write_chunk(self, chunks, chunk):
+        stream = self.request.connection.stream
+        if stream.closed() or isinstance(chunk, Exception):
+            if hasattr(chunks, "close"):
+                chunks.close()
+            if not stream.closed():
+                # Too late for an error page, the headers are out already
+                stream.close()
+            signals.request_finished.send(sender=middleware_provider.__class__)
+            return
+        if chunk is None:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            signals.request_finished.send(sender=middleware_provider.__class__)
+            self.finish()
+            return
+        if chunk:
+            self.write(chunk)
+        self._flush(functools.partial(self._stream_next, chunks))
+
+    def _flush(self, callback):
+        """Flush the output buffer and run callback once it has been sent"""
+        if _flush_takes_callback:
+            self.flush(callback=callback)
+        else:
+            self.flush()
+            self._wait_for_stream(callback)
+
+    def _wait_for_stream(self, callback):
+        stream = self.request.connection.stream
+        io_loop = request_io_loop(self.request)
+        if stream.closed() or not stream.writing():
+            io_loop.add_callback(callback)
+        else:
+            io_loop.add_timeout(time.time() + 0.01,
+                functools.partial(self._wait_for_stream, callback))
+
     def _apply_request_middleware(self, request):
-        signals.request_started.send(sender=middleware_provider.__class__)
-        middleware_provider()
-        
-        for func in middleware_provider._request_middleware:
-            func(request)
-            
-        return request
+        """Run the request middleware
 
-    def _apply_response_middleware(self, response):
-        middleware_provider()
-        for func in middleware_provider._response_middleware:
-            func(response)
+        Returns the response of a middleware which answered the request
+        itself (the view must not be called then), otherwise None.
+        """
+        signals.request_started.send(sender=middleware_provider.__class__)
+        return middleware_provider().process_request(request)
+
+    def _apply_response_middleware(self, request, response):
+        if not isinstance(response, HttpResponse):
+            return response
+        return middleware_provider().process_response(request, response)
+
+    def _process_response(self, request, response):
+        """Apply the response middleware and prepare the response for
+        sending (rendering, ETag, compression)"""
+        response = self._apply_response_middleware(request, response)
+        if isinstance(response, HttpResponse) and not is_streaming(response):
+            response = prepare_response(response, self.request)
         return response
-    
-    def process_request(self, *args, **kwargs): 
-        """ Actual view execution """
-        
-        response = None
-        req = DjangoRequest(self.request, self.cookies)
-        req = self._apply_request_middleware(req)
-        
+
+    def _call_view(self, request, *args, **kwargs):
+        """Run the view and the response middleware
+
+        Futures returned by the view are passed on as they are.  The call
+        is profiled if `rjdj.djangotornado.profiling` selects the request.
+        """
+        profiler = get_profiler()
+        if profiler is not None and profiler.should_profile(self.stats_name,
+                                                            self.request):
+            return profiler.runcall(self.stats_name, self._run_view,
+                                    request, *args, **kwargs)
+        return self._run_view(request, *args, **kwargs)
+
+    def _run_view(self, request, *args, **kwargs):
+        if settings.DEBUG:
+            try:
+                response = self._view(request, *args, **kwargs)
+                if is_future(response):
+                    return response
+                return self._process_response(request, response)
+            except Exception, e:
+                return self._get_stacktrace()
+        response = self._view(request, *args, **kwargs)
+        if is_future(response):
+            return response
+        return self._process_response(request, response)
+
+    def _wait_for_view(self, request, future):
+        """Return the response once the Future of the view is done"""
+        io_loop = request_io_loop(self.request)
+        callback = self.async_callback(self._on_view_done, request)
+        future.add_done_callback(
+            lambda future: add_callback(functools.partial(callback, future),
+                                        io_loop))
+
+    def _on_view_done(self, request, future):
         if settings.DEBUG:
             try:
-                response = self._view(req, *args, **kwargs)
+                response = future.result()
+                response = self._process_response(request, response)
             except Exception, e:
                 response = self._get_stacktrace()
         else:
-            response = self._view(req, *args, **kwargs)
+            response = future.result()
+            response = self._process_response(request, response)
+        self.return_response(response)
 
+    def process_request(self, *args, **kwargs): 
+        """ Actual view execution """
+        
+        self._start_deadline()
+        req = DjangoRequest(self.request, cancelled=self._cancelled)
+        response = self._apply_request_middleware(req)
+        if response is None:
+            response = self._call_view(req, *args, **kwargs)
+            if is_future(response):
+                self._auto_finish = False
+                self._wait_for_view(req, response)
+                return
+        else:
+            response = self._process_response(req, response)
         self.return_response(response)
 
 
@@ -220,39 +671,334 @@ class SynchronousDjangoHandler(RequestHandler):
 class DjangoHandler(SynchronousDjangoHandler):
     """Asynchronous Handler for Django views"""
 
+    _flight_key = None
+    _flight_leader = False
+    _prepared = None
+
+    def initialize(self, django_view, **kwargs):
+        """With ``coalesce``, concurrent GET and HEAD requests for the
+        same URL share one run of the view: later requests wait for the
+        first and get its response, if the response cache could store
+        it, otherwise they run the view themselves.  ``coalesce`` is
+        True (the ``vary`` rules of the ``cache`` option apply, if any)
+        or a dict with ``vary`` and ``vary_cookies`` like ``cache``.
+        """
+        super(DjangoHandler, self).initialize(django_view, **kwargs)
+        coalesce = kwargs.get("coalesce")
+        if isinstance(coalesce, dict):
+            coalesce = CachePolicy(None, **coalesce)
+        elif coalesce and not isinstance(coalesce, CachePolicy):
+            coalesce = self._cache_policy or CachePolicy(None)
+        self._coalesce = coalesce or None
+
     def start_thread(self, request, cookies, *args, **kwargs):
-        request = DjangoRequest(request, cookies)
-        request = self._apply_request_middleware(request)
-        thread = Thread(target = self.worker,
-                        args = (request,) + args,
-                        kwargs = kwargs)
-        thread.daemon = True
-        thread.start()
-
-    def worker(self, *args, **kwargs):
-        """Worker that is processes in separate thread"""
-        if settings.DEBUG:
-            try:
-                res = self._view(*args, **kwargs)
-            except Exception, e:
-                res = self._get_stacktrace()
-        else:
-            res = self._view(*args, **kwargs)
+        """Hand the view over to the shared worker pool
+
+        Sends a 503 if the pool's queue is full.  Responses of request
+        middleware are returned right away without using the pool.
+        """
+        self._start_deadline()
+        if self._coalesce is not None and \
+           self.request.method in ("GET", "HEAD"):
+            self._flight_key = (self.request.method,) + \
+                               self._coalesce.key(self, ())
+            self._flight_leader = get_single_flight().join(
+                self._flight_key, self)
+            if not self._flight_leader:
+                self._flight_args = (request, cookies, args, kwargs)
+                return
+        self._start(request, cookies, *args, **kwargs)
+
+    def _start(self, request, cookies, *args, **kwargs):
+        request = DjangoRequest(request, cookies, self._cancelled)
+        response = self._apply_request_middleware(request)
+        if response is not None:
+            self.return_response(
+                self._process_response(request, response))
+            return
+        if self._coroutine:
+            # Coroutines run on the IOLoop, no need for a thread
+            self.run_coroutine(request, *args, **kwargs)
+            return
+        try:
+            self._job = get_worker_pool().submit(self.worker, request,
+                                                 *args, **kwargs)
+        except WorkerPoolFull:
+            signals.request_finished.send(sender=middleware_provider.__class__)
+            self.send_error(503)
 
-        cb = self.async_callback(self.return_response, res)
-        io_loop = IOLoop.instance()
-        io_loop.add_callback(cb)
+    def write_prepared(self, prepared):
+        self._prepared = prepared
+        super(DjangoHandler, self).write_prepared(prepared)
 
-    def prepare(self):
-        """Override prepare"""
-        # this would be the place for Django Middleware
+    def _land(self):
+        """Hand the response to the requests following this one"""
+        key, self._flight_key = self._flight_key, None
+        if key is None:
+            return
+        if not self._flight_leader:
+            get_single_flight().leave(key, self)
+            return
+        for follower in get_single_flight().land(key):
+            add_callback(
+                follower.async_callback(follower._on_landed, self,
+                                        self._prepared),
+                request_io_loop(follower.request))
+
+    def _on_landed(self, leader, prepared):
+        """Send the response of the leader if it may be shared, else run
+        the view"""
+        self._flight_key = None
+        if self._finished or self.request.connection.stream.closed():
+            return
+        if prepared is not None and not prepared.cookies and \
+           self._coalesce.is_cacheable(prepared.status_code,
+                                       prepared.headers):
+            vary = response_vary(prepared.headers)
+            if not vary or self._coalesce.key(self, vary) == \
+                           self._coalesce.key(leader, vary):
+                if is_not_modified(self.request.headers,
+                                   prepared.get_header("Etag"),
+                                   prepared.get_header("Last-Modified")):
+                    prepared = not_modified(prepared)
+                self.write_prepared(prepared)
+                self.finish()
+                return
+        request, cookies, args, kwargs = self._flight_args
+        self._start(request, cookies, *args, **kwargs)
+
+    def on_connection_close(self):
+        super(DjangoHandler, self).on_connection_close()
+        self._land()
+
+    def finish(self, *args, **kwargs):
+        try:
+            return super(DjangoHandler, self).finish(*args, **kwargs)
+        finally:
+            self._land()
+
+    def run_coroutine(self, request, *args, **kwargs):
+        """Run a coroutine view on the IOLoop"""
+        response = self._call_view(request, *args, **kwargs)
+        if is_future(response):
+            self._wait_for_view(request, response)
+        else:
+            self.return_response(response)
+
+    def worker(self, request, *args, **kwargs):
+        """Worker that is processed in a thread of the worker pool"""
+        try:
+            acquire_connections()
+        except ConnectionPoolTimeout:
+            logger.warning("No database connection for %s", self.request.uri,
+                           exc_info=True)
+            add_callback(self.async_callback(self._unavailable),
+                         request_io_loop(self.request))
+            return
+        try:
+            res = self._call_view(request, *args, **kwargs)
+        except Exception:
+            logger.error("Exception in view for %s", self.request.uri,
+                         exc_info=True)
+            add_callback(self.async_callback(self._unavailable, 500),
+                         request_io_loop(self.request))
+            return
+        finally:
+            release_connections()
+        if is_future(res):
+            self._wait_for_view(request, res)
+            return
+
+        add_callback(self.async_callback(self.return_response, res),
+                     request_io_loop(self.request))
+
+    def _next_chunk(self, chunks, callback):
+        """Iterate the response content in the worker pool"""
+        io_loop = request_io_loop(self.request)
+        on_chunk = lambda chunk: add_callback(
+            functools.partial(callback, chunk), io_loop)
+        try:
+            get_worker_pool().submit(self._fetch_chunk, chunks, on_chunk)
+        except WorkerPoolFull:
+            super(DjangoHandler, self)._next_chunk(chunks, callback)
+
+    def _unavailable(self, status_code=503):
+        """Answer a request that the worker could not serve
+
+        Requests coalesced with this one are released even if sending
+        the error fails; they run the view themselves then.
+        """
+        if self._finished:
+            return
+        try:
+            signals.request_finished.send(
+                sender=middleware_provider.__class__)
+            self.send_error(status_code)
+        finally:
+            self._land()
+
+    def _fetch_chunk(self, chunks, callback):
+        try:
+            acquire_connections()
+        except ConnectionPoolTimeout, e:
+            callback(e)
+            return
+        try:
+            super(DjangoHandler, self)._next_chunk(chunks, callback)
+        finally:
+            release_connections()
 
     @asynchronous
     def get(self, *args, **kwargs):
         """GET Handler"""
-        self.start_thread(self.request, self.cookies, *args, **kwargs)
+        self.start_thread(self.request, None, *args, **kwargs)
 
     @asynchronous
     def post(self, *args, **kwargs):
         """POST Handler"""
-        self.start_thread(self.request, self.cookies, *args, **kwargs)
+        self.start_thread(self.request, None, *args, **kwargs)
+
+
+class DjangoWSGIContainer(WSGIContainer):
+    """WSGIContainer which records its requests in the runtime stats
+
+    Other than Tornado's WSGIContainer it passes spooled request bodies
+    (see `rjdj.djangotornado.server`) on as ``wsgi.input``.
+    """
+
+    stats_name = "django_fallback"
+
+    def __call__(self, request):
+        data = {}
+        response = []
+        def start_response(status, response_headers, exc_info=None):
+            data["status"] = status
+            data["headers"] = response_headers
+            return response.append
+        app_response = self.wsgi_application(wsgi_environ(request),
+                                             start_response)
+        try:
+            response.extend(app_response)
+        finally:
+            if hasattr(app_response, "close"):
+                app_response.close()
+        if not data:
+            raise Exception("WSGI app did not call start_response")
+
+        status_code = int(data["status"].split()[0])
+        headers = data["headers"]
+        body = escape.utf8("".join(response))
+        header_set = set(k.lower() for (k,v) in headers)
+        if "content-length" not in header_set:
+            headers.append(("Content-Length", str(len(body))))
+        if "content-type" not in header_set:
+            headers.append(("Content-Type", "text/html; charset=UTF-8"))
+        if "server" not in header_set:
+            headers.append(("Server", "TornadoServer/%s" % tornado.version))
+
+        parts = [escape.utf8("HTTP/1.1 " + data["status"] + "\r\n")]
+        for key, value in headers:
+            parts.append(escape.utf8(key) + ": " + escape.utf8(value) + "\r\n")
+        parts.append("\r\n")
+        parts.append(body)
+        request.write("".join(parts))
+        request.finish()
+        self._log(status_code, request)
+
+    def _log(self, status_code, request):
+        get_stats().record_request(self.stats_name, status_code,
+                                   request.request_time())
+        super(DjangoWSGIContainer, self)._log(status_code, request)
+
+
+class WSGIFallbackHandler(RequestHandler):
+    """Non-blocking replacement for Tornado's FallbackHandler
+
+    The WSGI application (usually Django's ``WSGIHandler``) runs in the
+    worker pool; only the finished response is written on the IOLoop.
+    Other than ``FallbackHandler`` it takes the bare WSGI application,
+    not a ``WSGIContainer``.
+    """
+
+    def initialize(self, fallback):
+        self.fallback = fallback
+        self._container = DjangoWSGIContainer(fallback)
+        # Errors sent by the handler itself count for the fallback too
+        self.stats_name = self._container.stats_name
+
+    @asynchronous
+    def process_request(self, *args, **kwargs):
+        environ = wsgi_environ(self.request)
+        environ["wsgi.multithread"] = True
+        try:
+            get_worker_pool().submit(self.worker, environ)
+        except WorkerPoolFull:
+            self.send_error(503)
+
+    get = post = put = delete = head = options = process_request
+
+    def worker(self, environ):
+        """Run the WSGI application in a thread of the worker pool"""
+        data = {}
+        response = []
+        def start_response(status, response_headers, exc_info=None):
+            data["status"] = status
+            data["headers"] = response_headers
+            return response.append
+        try:
+            acquire_connections()
+        except ConnectionPoolTimeout:
+            logger.warning("No database connection for %s", self.request.uri,
+                           exc_info=True)
+            add_callback(self.async_callback(self.send_error, 503),
+                         request_io_loop(self.request))
+            return
+        try:
+            app_response = self.fallback(environ, start_response)
+            try:
+                response.extend(app_response)
+            finally:
+                if hasattr(app_response, "close"):
+                    app_response.close()
+            if not data:
+                raise Exception("WSGI app did not call start_response")
+        except Exception:
+            import traceback
+            traceback.print_exc(limit=10)
+            data["status"] = "500 Internal Server Error"
+            data["headers"] = [("Content-Type", "text/plain; charset=utf-8")]
+            response = ["500 Internal Server Error"]
+        finally:
+            release_connections()
+
+        body = escape.utf8("".join(response))
+        headers = data["headers"]
+        header_set = set(k.lower() for (k,v) in headers)
+        if "content-length" not in header_set:
+            headers.append(("Content-Length", str(len(body))))
+        if "content-type" not in header_set:
+            headers.append(("Content-Type", "text/html; charset=UTF-8"))
+        if "server" not in header_set:
+            headers.append(("Server", "TornadoServer/%s" % tornado.version))
+
+        parts = [escape.utf8("HTTP/1.1 " + data["status"] + "\r\n")]
+        for key, value in headers:
+            parts.append(escape.utf8(key) + ": " + escape.utf8(value) + "\r\n")
+        parts.append("\r\n")
+        parts.append(body)
+
+        status_code = int(data["status"].split()[0])
+        cb = self.async_callback(self.return_response, status_code, "".join(parts))
+        add_callback(cb, request_io_loop(self.request))
+
+    def return_response(self, status_code, data):
+        """Write the raw response built by the worker"""
+        stream = self.request.connection.stream
+        if stream.closed():
+            return
+        stream.set_close_callback(None)
+        self.request.write(data)
+        self.request.finish()
+        self._finished = True
+        self._container._log(status_code, self.request)
+
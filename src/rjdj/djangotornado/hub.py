@@ -0,0 +1,299 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import json
+import time
+import functools
+
+from collections import deque, OrderedDict
+from threading import Lock
+
+from tornado.web import RequestHandler, asynchronous
+
+from django.conf import settings
+
+from rjdj.djangotornado.pool import add_callback, current_io_loop
+from rjdj.djangotornado.coroutines import Future
+from rjdj.djangotornado.handlers import request_io_loop
+
+
+class Channel(object):
+    """Buffer of the last ``buffer_size`` messages published on a channel
+
+    Every message gets the next sequence number of the channel, starting
+    with 1, so clients can ask for the messages after the last one they
+    have seen.
+    """
+
+    def __init__(self, name, buffer_size=100):
+        self.name = name
+        self.last_seq = 0
+        self.messages = deque(maxlen=buffer_size)
+        self.waiters = []
+
+    def since(self, seq):
+        """Return the buffered (seq, message) pairs after seq"""
+        if seq >= self.last_seq:
+            return []
+        return [(s, m) for (s, m) in self.messages if s > seq]
+
+    def missed(self, seq):
+        """True if messages after seq have already left the buffer
+
+        A seq beyond the last one is from before a restart of the
+        server, anything may have been missed then.
+        """
+        if seq > self.last_seq:
+            return True
+        if not self.messages:
+            return seq < self.last_seq
+        return self.messages[0][0] > seq + 1
+
+
+class Waiter(object):
+    """A request parked on a channel until a message is published"""
+
+    def __init__(self, channel, since, callback, io_loop):
+        self.channel = channel
+        self.since = since
+        self.callback = callback
+        self.io_loop = io_loop
+
+
+class Hub(object):
+    """Publish/subscribe hub for requests waiting on the IOLoop
+
+    `publish` may be called from any thread, e.g. in Django signal
+    receivers running in a worker.  Subscribers are called on their
+    IOLoop with the list of new ``(seq, message)`` pairs, once; to
+    receive further messages they subscribe again with the last
+    sequence number they got.
+
+    Channels are created by `publish` or when a subscriber has to wait.
+    A channel nobody published on goes away with its last waiter; of
+    the others at most ``max_channels`` are kept, the one published on
+    least recently is dropped first unless it has waiters.
+    """
+
+    def __init__(self, buffer_size=100, max_channels=10000):
+        self.buffer_size = buffer_size
+        self.max_channels = max_channels
+        self._channels = OrderedDict()
+        self._lock = Lock()
+
+    def _add_channel(self, name):
+        """Create channel name (caller must hold the lock)"""
+        channel = self._channels[name] = Channel(name, self.buffer_size)
+        if len(self._channels) > self.max_channels:
+            for other in self._channels.values():
+                if not other.waiters and other is not channel:
+                    del self._channels[other.name]
+                    break
+        return channel
+
+    def publish(self, name, message):
+        """Append message to channel name and wake its waiters
+
+        Returns the sequence number of the message.
+        """
+        with self._lock:
+            channel = self._channels.pop(name, None)
+            if channel is None:
+                channel = self._add_channel(name)
+            else:
+                # Most recently published channels are dropped last
+                self._channels[name] = channel
+            channel.last_seq += 1
+            seq = channel.last_seq
+            channel.messages.append((seq, message))
+            waiters, channel.waiters = channel.waiters, []
+            deliveries = [(waiter, channel.since(waiter.since))
+                          for waiter in waiters]
+        for waiter, messages in deliveries:
+            add_callback(functools.partial(waiter.callback, messages),
+                         waiter.io_loop)
+        return seq
+
+    def subscribe(self, name, since, callback, io_loop=None):
+        """Call callback with the messages after since
+
+        Buffered messages are passed right away (on the calling thread),
+        otherwise the callback is called on io_loop (the current one by
+        default) with the next message.  A since beyond the last message
+        (e.g. from before a restart) waits for the next message.
+        Returns the `Waiter` to pass to `unsubscribe`, or None if the
+        callback was called already.
+        """
+        with self._lock:
+            channel = self._channels.get(name)
+            if channel is None:
+                channel = self._add_channel(name)
+            since = min(since, channel.last_seq)
+            messages = channel.since(since)
+            if not messages:
+                waiter = Waiter(name, since, callback,
+                                io_loop or current_io_loop())
+                channel.waiters.append(waiter)
+                return waiter
+        callback(messages)
+        return None
+
+    def unsubscribe(self, waiter):
+        """Remove a waiter, e.g. after a timeout or disconnect"""
+        with self._lock:
+            channel = self._channels.get(waiter.channel)
+            if channel is not None and waiter in channel.waiters:
+                channel.waiters.remove(waiter)
+                if not channel.waiters and not channel.last_seq:
+                    del self._channels[channel.name]
+
+    def wait(self, name, since, io_loop=None):
+        """Return a Future for the messages after since
+
+        Meant for coroutine views, which yield it.
+        """
+        future = Future()
+        self.subscribe(name, since, future.set_result, io_loop)
+        return future
+
+    def last_seq(self, name):
+        """Sequence number of the last message published on channel name"""
+        with self._lock:
+            channel = self._channels.get(name)
+            return channel.last_seq if channel is not None else 0
+
+    def missed(self, name, since):
+        """True if messages after since have been dropped from the buffer"""
+        with self._lock:
+            channel = self._channels.get(name)
+            if channel is None:
+                return since > 0
+            return channel.missed(since)
+
+    def stats(self):
+        with self._lock:
+            return {"channels": len(self._channels),
+                    "waiters": sum(len(c.waiters)
+                                   for c in self._channels.values())}
+
+
+_hub = None
+_hub_lock = Lock()
+
+def get_hub():
+    """Return the shared hub
+
+    Channels keep the last ``TORNADO_HUB_BUFFER_SIZE`` messages
+    (default 100); at most ``TORNADO_HUB_MAX_CHANNELS`` channels (default
+    10000) are kept.
+    """
+    global _hub
+    if _hub is None:
+        with _hub_lock:
+            if _hub is None:
+                _hub = Hub(getattr(settings, "TORNADO_HUB_BUFFER_SIZE", 100),
+                           getattr(settings, "TORNADO_HUB_MAX_CHANNELS",
+                                   10000))
+    return _hub
+
+def publish(name, message):
+    """Publish message on channel name of the shared hub"""
+    return get_hub().publish(name, message)
+
+
+class LongPollHandler(RequestHandler):
+    """Long polling on a channel of the hub
+
+    ``GET ?since=<seq>`` answers with the messages published after
+    ``seq`` as JSON, right away if there are some in the buffer, else
+    with the next one or an empty list after ``timeout`` seconds.
+    Without ``since`` the request waits for the next message.  The
+    channel is the ``channel`` option of the route or its first group::
+
+        {"channel": "news", "last_seq": 12, "missed": false,
+         "messages": [{"seq": 12, "data": ...}]}
+
+    ``missed`` is true if messages after ``since`` were dropped from
+    the buffer already.  No thread is held while a request waits.
+    """
+
+    def initialize(self, channel=None, timeout=30.0, hub=None):
+        self.channel = channel
+        self.timeout = timeout
+        self.hub = hub or get_hub()
+        self._waiter = None
+        self._timeout = None
+
+    @asynchronous
+    def get(self, *args):
+        self.channel = self.channel or args[0]
+        since = self.get_argument("since", None)
+        if since is None:
+            since = self.hub.last_seq(self.channel)
+        try:
+            self.since = int(since)
+        except ValueError:
+            self.send_error(400)
+            return
+        self._io_loop = request_io_loop(self.request)
+        self._waiter = self.hub.subscribe(
+            self.channel, self.since, self.async_callback(self._respond),
+            self._io_loop)
+        if self._waiter is not None and self.timeout:
+            self._timeout = self._io_loop.add_timeout(
+                time.time() + self.timeout,
+                self.async_callback(self._on_timeout))
+
+    def _on_timeout(self):
+        self._timeout = None
+        self._unsubscribe()
+        self._respond([])
+
+    def _unsubscribe(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            self.hub.unsubscribe(waiter)
+
+    def _respond(self, messages):
+        if self._finished or self.request.connection.stream.closed():
+            return
+        self._waiter = None
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        last_seq = messages[-1][0] if messages else self.since
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Cache-Control", "no-cache")
+        self.finish(json.dumps({
+            "channel": self.channel,
+            "last_seq": last_seq,
+            "missed": self.hub.missed(self.channel, self.since),
+            "messages": [{"seq": seq, "data": data}
+                         for seq, data in messages]}))
+
+    def on_connection_close(self):
+        self._unsubscribe()
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
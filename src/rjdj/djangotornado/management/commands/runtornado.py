@@ -24,6 +24,7 @@ __docformat__ = "reStructuredText"
 
 import os
 import sys
+import signal
 
 import logging
 from optparse import make_option
@@ -48,7 +49,17 @@ class WelcomeHandler(RequestHandler):
 
 
 class Command(BaseCommand):
-    option_list = BaseCommand.option_list
+    option_list = BaseCommand.option_list + (
+        make_option('--async-fallback', action='store_true',
+                    dest='async_fallback',
+                    default=False,
+                    help='Run the Django fallback application in the '
+                         'worker pool instead of on the IOLoop.'),
+        make_option('--processes', action='store', type='int',
+                    dest='processes', default=None,
+                    help='Number of forked server processes sharing the '
+                         'socket (0 means one per CPU, default is 1).'),
+        )
     help = "Starts a single threaded Tornado web server."
     args = '[optional port number, or ipaddr:port]'
 
@@ -73,6 +84,11 @@ class Command(BaseCommand):
         if not self.port.isdigit():
             raise CommandError("%r is not a valid port number." % port)
 
+        self.async_fallback = options.get("async_fallback") or \
+                              getattr(settings, "TORNADO_ASYNC_FALLBACK", False)
+        self.processes = options.get("processes")
+        if self.processes is None:
+            self.processes = getattr(settings, "TORNADO_PROCESSES", 1)
         self.quit_command = (sys.platform == 'win32') and 'CTRL-BREAK' or 'CONTROL-C'
         self.inner_run()
 
@@ -90,11 +106,19 @@ class Command(BaseCommand):
         from tornado import wsgi
         from tornado.web import FallbackHandler, StaticFileHandler
 
+        if getattr(self, "async_fallback", False):
+            from rjdj.djangotornado.handlers import WSGIFallbackHandler
+            fallback_handler = WSGIFallbackHandler
+            django_app = WSGIHandler()
+        else:
+            from rjdj.djangotornado.handlers import DjangoWSGIContainer
+            fallback_handler = FallbackHandler
+            django_app = DjangoWSGIContainer(WSGIHandler())
+
         # Patch prepare method from Tornado's FallbackHandler
         from rjdj.djangotornado import patches
-        FallbackHandler.prepare = patches.patch_prepare(FallbackHandler.prepare)
+        fallback_handler.prepare = patches.patch_prepare(fallback_handler.prepare)
 
-        django_app = wsgi.WSGIContainer(WSGIHandler())
         handlers = []
         try:
             urls =  __import__(settings.ROOT_URLCONF,
@@ -106,11 +130,22 @@ class Command(BaseCommand):
         except ImportError:
             logger.warn("No Tornado URL specified.")
 
+        if getattr(settings, "TORNADO_STATIC_CACHE", True):
+            from rjdj.djangotornado.static import CachedStaticFileHandler
+            static_handler = CachedStaticFileHandler
+        else:
+            static_handler = StaticFileHandler
+
+        stats_url = getattr(settings, "TORNADO_STATS_URL", None)
+        if stats_url:
+            from rjdj.djangotornado.stats import StatsHandler
+            handlers.append((stats_url, StatsHandler))
+
         admin_media_path, admin_media_url = self.admin_media()
         handlers += (
             (r'/_', WelcomeHandler),
-            (r'%s(.*)' % admin_media_url, StaticFileHandler, {"path": admin_media_path}),
-            (r'.*', FallbackHandler, dict(fallback=django_app)),
+            (r'%s(.*)' % admin_media_url, static_handler, {"path": admin_media_path}),
+            (r'.*', fallback_handler, dict(fallback=django_app)),
             )
         return patches.DjangoApplication(handlers, **{"debug": settings.DEBUG})
 
@@ -121,7 +156,9 @@ class Command(BaseCommand):
     def inner_run(self):
         """Get handler and start IOLoop"""
         import django
-        from tornado import httpserver, ioloop
+        from tornado import ioloop
+        from rjdj.djangotornado.server import DjangoHTTPServer
+        from rjdj.djangotornado.stats import IOLoopMonitor
 
         parse_command_line()
 
@@ -140,10 +177,26 @@ class Command(BaseCommand):
         app = self.get_handler()
         set_application(app)
 
-        server = httpserver.HTTPServer(app)
-        server.listen(int(self.port), address=self.addr)
+        server = DjangoHTTPServer(app)
+        server.bind(int(self.port), address=self.addr)
+        processes = getattr(self, "processes", 1)
+        if processes != 1:
+            from django.db import connections
+            from rjdj.djangotornado.process import fork_workers
+
+            # Children must not share the parent's database connections
+            for connection in connections.all():
+                connection.close()
+            fork_workers(processes)
+        server.start(1)
+
+        io_loop = ioloop.IOLoop.instance()
+        IOLoopMonitor(io_loop).start()
+        def on_sigterm(signum, frame):
+            io_loop.add_callback(io_loop.stop)
+        signal.signal(signal.SIGTERM, on_sigterm)
         try:
-            ioloop.IOLoop.instance().start()
+            io_loop.start()
         except KeyboardInterrupt:
             logger.warn("Shutting down Tornado ...")
         finally:
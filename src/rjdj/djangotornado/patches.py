@@ -26,7 +26,14 @@ import re
 import logging
 
 from tornado import escape
-from tornado.web import Application, URLSpec
+from tornado.web import Application, URLSpec, ErrorHandler
+
+from rjdj.djangotornado.stats import record_request
+
+# Characters that end the literal part of a URL pattern
+_REGEX_SPECIAL = frozenset(".^$*+?{}[]\\|()")
+# Quantifiers that make the preceding literal character optional
+_REGEX_QUANTIFIERS = frozenset("*+?{")
 
 def patch_prepare(func):
     """Patches the Cookie header in the Tornado request to fulfull
@@ -44,8 +51,107 @@ def patch_prepare(func):
     return inner_func
 
 
+def literal_prefix(pattern):
+    """Returns the literal text every match of ``pattern`` starts with
+
+    Returns None for patterns with a top-level alternation which may
+    match paths with different prefixes.
+    """
+    if "|" in pattern:
+        return None
+    if pattern.startswith("^"):
+        pattern = pattern[1:]
+    prefix = []
+    for char in pattern:
+        if char in _REGEX_SPECIAL:
+            if char in _REGEX_QUANTIFIERS and prefix:
+                prefix.pop()
+            break
+        prefix.append(char)
+    else:
+        # The whole pattern is literal
+        return "".join(prefix) + "$"
+    if char == "$":
+        prefix.append("$")
+    return "".join(prefix)
+
+def first_segment(pattern):
+    """Returns the first path segment of all paths matched by ``pattern``
+
+    Returns None if the pattern does not fix its first segment, e.g.
+    ``/(.*)`` or ``/foo.*``.
+    """
+    prefix = literal_prefix(pattern)
+    if not prefix or not prefix.startswith("/"):
+        return None
+    rest = prefix[1:]
+    for end in ("/", "$"):
+        if end in rest:
+            return rest[:rest.index(end)]
+    return None
+
+
+class RouteIndex(object):
+    """Index of URLSpecs by the first segment of the request path
+
+    Every spec whose pattern starts with a literal first path segment
+    (like ``/admin/...`` or ``/api$``) is put into the bucket of that
+    segment, all other specs are generic and may match any path.  For a
+    request only the specs of its bucket plus the generic ones are
+    tried, in the order they were added, so the first matching spec
+    still wins.
+    """
+
+    # Returned for paths no spec can match.  Tornado redirects to the
+    # default host if it gets an empty handler list, so this has to be
+    # a spec which never matches and lets Tornado respond with 404.
+    no_match = [URLSpec(r"(?!)", ErrorHandler)]
+
+    def __init__(self, specs):
+        self.size = len(specs)
+        buckets = {}
+        generic = []
+        for position, spec in enumerate(specs):
+            segment = first_segment(spec.regex.pattern)
+            if segment is None:
+                generic.append((position, spec))
+            else:
+                buckets.setdefault(segment, []).append((position, spec))
+        self.generic = [spec for position, spec in generic] or self.no_match
+        self.buckets = dict(
+            (segment, [spec for position, spec in sorted(entries + generic)])
+            for segment, entries in buckets.iteritems())
+
+    def candidates(self, path):
+        """Returns the specs which may match ``path`` in dispatch order"""
+        if path.startswith("/"):
+            end = path.find("/", 1)
+            segment = path[1:end] if end >= 0 else path[1:]
+            specs = self.buckets.get(segment)
+            if specs is not None:
+                return specs
+        return self.generic
+
+
 class DjangoApplication(Application):
-    
+    """Application which dispatches requests through a `RouteIndex` and
+    records the requests in the runtime `rjdj.djangotornado.stats`"""
+
+    def log_request(self, handler):
+        record_request(handler)
+        super(DjangoApplication, self).log_request(handler)
+
+    def _get_host_handlers(self, request):
+        handlers = super(DjangoApplication, self)._get_host_handlers(request)
+        if handlers is None:
+            return None
+        indexes = self.__dict__.setdefault("_route_indexes", {})
+        index = indexes.get(id(handlers))
+        if index is None or index.size != len(handlers):
+            # Handler lists may be extended after add_handlers()
+            index = indexes[id(handlers)] = RouteIndex(handlers)
+        return index.candidates(request.path)
+
     def add_handlers(self, host_pattern, host_handlers):
         """Appends the given handlers to our handler list.
 
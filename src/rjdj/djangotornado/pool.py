@@ -0,0 +1,356 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import os
+import time
+import errno
+import fcntl
+import logging
+
+from collections import deque
+from Queue import Queue, Empty, Full
+from threading import Thread, Lock, local
+
+from tornado.ioloop import IOLoop
+
+from django.conf import settings
+
+
+logger = logging.getLogger()
+
+
+class WorkerPoolFull(Exception):
+    """Raised if a job is submitted while the queue is full"""
+
+
+class Job(object):
+    """A function call submitted to a `WorkerPool`"""
+
+    def __init__(self, pool, func, args, kwargs):
+        self.pool = pool
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted = time.time()
+        self.cancelled = False
+        self.abandoned = False
+        self.running = False
+        self.done = False
+        self._core = False
+        self._replaced = False
+
+    def cancel(self):
+        """Drop the job if it is still queued; returns True if dropped"""
+        return self.pool._cancel(self, abandon=False)
+
+    def abandon(self):
+        """Drop the job if queued, or give up the thread running it
+
+        A running job cannot be interrupted, but its thread is given
+        up: a new thread takes its place right away as long as the
+        threads of the pool, abandoned ones included, stay within
+        ``max_size``.  Otherwise the thread returns to the pool once the
+        job is done.  Returns True unless the job was done already.
+        """
+        return self.pool._cancel(self, abandon=True)
+
+
+class WorkerPool(object):
+    """Fixed set of worker threads fed by a bounded job queue
+
+    ``size`` threads are started up front and live as long as the
+    pool.  If ``max_size`` is larger than ``size`` the pool grows
+    whenever a job arrives while every thread is busy; those extra
+    threads exit again after ``idle_timeout`` seconds without work.
+    ``queue_size`` limits the number of waiting jobs (0 means no limit).
+    Threads still running abandoned jobs count against ``max_size``;
+    while they cannot be replaced, jobs are only accepted if a thread
+    is not busy.  The time jobs wait in the queue is observed by ``wait_histogram``
+    (a `rjdj.djangotornado.stats.Histogram`) if given.
+    """
+
+    def __init__(self, size=10, queue_size=100, max_size=None,
+                 idle_timeout=60.0, wait_histogram=None):
+        if size < 1:
+            raise ValueError("Worker pool needs at least one thread")
+        self.size = size
+        self.max_size = max(max_size or size, size)
+        self.idle_timeout = idle_timeout
+        self.wait_histogram = wait_histogram
+        self._queue = Queue(queue_size)
+        self._lock = Lock()
+        self._threads = 0
+        self._busy = 0
+        self._abandoned = 0
+        self._stopped = False
+        for i in range(size):
+            self._spawn(core=True)
+
+    def _spawn(self, core=False):
+        """Start a new worker thread (caller must not hold the lock)"""
+        with self._lock:
+            self._threads += 1
+        thread = Thread(target=self._run, args=(core,),
+                        name="DjangoWorker-%d" % self._threads)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, core):
+        while True:
+            try:
+                if core:
+                    job = self._queue.get()
+                else:
+                    job = self._queue.get(timeout=self.idle_timeout)
+            except Empty:
+                with self._lock:
+                    # Leave only if no job sneaked in meanwhile
+                    if self._queue.empty():
+                        self._threads -= 1
+                        return
+                continue
+            if job is None:
+                with self._lock:
+                    self._threads -= 1
+                return
+            with self._lock:
+                if job.cancelled:
+                    continue
+                job.running = True
+                job._core = core
+                self._busy += 1
+            if self.wait_histogram is not None:
+                self.wait_histogram.observe(time.time() - job.submitted)
+            try:
+                job.func(*job.args, **job.kwargs)
+            except Exception:
+                logger.error("Uncaught exception in worker thread",
+                             exc_info=True)
+            finally:
+                with self._lock:
+                    job.done = True
+                    if not job.abandoned:
+                        self._busy -= 1
+            if job.abandoned:
+                with self._lock:
+                    self._abandoned -= 1
+                    rejoin = not job._replaced and not self._stopped
+                    if rejoin:
+                        self._threads += 1
+                if not rejoin:
+                    # Replaced by another thread already
+                    return
+
+    def submit(self, func, *args, **kwargs):
+        """Queue ``func(*args, **kwargs)`` for execution in a worker
+
+        Returns the `Job`.  Raises `WorkerPoolFull` if the job queue has
+        no room left.
+        """
+        if self._stopped:
+            raise WorkerPoolFull("Worker pool has been stopped")
+        with self._lock:
+            stuck = (self._abandoned and
+                     self._threads + self._abandoned >= self.max_size and
+                     self._busy >= self._threads)
+        if stuck:
+            raise WorkerPoolFull("Worker threads are stuck in abandoned jobs")
+        job = Job(self, func, args, kwargs)
+        try:
+            self._queue.put_nowait(job)
+        except Full:
+            raise WorkerPoolFull("Worker queue is full")
+        with self._lock:
+            grow = (self._threads + self._abandoned < self.max_size and
+                    self._busy + self._queue.qsize() > self._threads)
+        if grow:
+            self._spawn()
+        return job
+
+    def _cancel(self, job, abandon):
+        with self._lock:
+            if job.done or job.abandoned:
+                return False
+            if not job.running:
+                # Skipped once a worker takes it from the queue
+                job.cancelled = True
+                return True
+            if not abandon:
+                return False
+            job.abandoned = True
+            self._busy -= 1
+            self._threads -= 1
+            self._abandoned += 1
+            job._replaced = (not self._stopped and
+                             self._threads + self._abandoned < self.max_size)
+        if job._replaced:
+            self._spawn(core=job._core)
+        return True
+
+    def stop(self):
+        """Let all worker threads exit after the queued jobs are done"""
+        self._stopped = True
+        with self._lock:
+            threads = self._threads
+        for i in range(threads):
+            self._queue.put(None)
+
+    def stats(self):
+        with self._lock:
+            return {"threads": self._threads,
+                    "abandoned": self._abandoned,
+                    "busy": self._busy,
+                    "queued": self._queue.qsize()}
+
+
+_pool = None
+_pool_lock = Lock()
+
+def get_worker_pool():
+    """Return the shared worker pool, created on first use
+
+    The pool is configured with the Django settings
+    ``TORNADO_WORKER_POOL_SIZE`` (default 10),
+    ``TORNADO_WORKER_POOL_MAX_SIZE`` (default: same as size) and
+    ``TORNADO_WORKER_QUEUE_SIZE`` (default 100).
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from rjdj.djangotornado.stats import get_stats
+                size = getattr(settings, "TORNADO_WORKER_POOL_SIZE", 10)
+                _pool = WorkerPool(
+                    size,
+                    queue_size=getattr(settings,
+                                       "TORNADO_WORKER_QUEUE_SIZE", 100),
+                    max_size=getattr(settings,
+                                     "TORNADO_WORKER_POOL_MAX_SIZE", size),
+                    wait_histogram=get_stats().queue_wait)
+    return _pool
+
+def worker_pool_stats():
+    """Stats of the worker pool, None if it has not been created"""
+    if _pool is None:
+        return None
+    return _pool.stats()
+
+
+class CallbackQueue(object):
+    """Hands callbacks from worker threads over to an IOLoop
+
+    ``IOLoop.add_callback`` of Tornado 2.0 swaps its callback list
+    without a lock, so a callback appended from another thread while the
+    loop runs the previous ones can get lost, leaving the request hanging.
+    The callbacks go into a deque instead and the loop is woken up through
+    a pipe of its own.
+    """
+
+    def __init__(self, io_loop):
+        self.io_loop = io_loop
+        self._callbacks = deque()
+        self._reader, self._writer = os.pipe()
+        for fd in (self._reader, self._writer):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        io_loop.add_handler(self._reader, self._run_callbacks, IOLoop.READ)
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+        try:
+            os.write(self._writer, "x")
+        except OSError, e:
+            # A full pipe wakes up the loop anyway
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _run_callbacks(self, fd, events):
+        try:
+            while os.read(self._reader, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        while self._callbacks:
+            self.io_loop.add_callback(self._callbacks.popleft())
+
+    def close(self):
+        self.io_loop.remove_handler(self._reader)
+        os.close(self._reader)
+        os.close(self._writer)
+
+
+_callback_queue_lock = Lock()
+
+def add_callback(callback, io_loop=None):
+    """Thread-safe ``io_loop.add_callback`` (IOLoop.instance() by default)"""
+    io_loop = io_loop or IOLoop.instance()
+    if hasattr(io_loop, "_callback_lock"):
+        # Tornado 2.1 and later lock the callback list themselves
+        io_loop.add_callback(callback)
+        return
+    queue = getattr(io_loop, "_djangotornado_callbacks", None)
+    if queue is None:
+        with _callback_queue_lock:
+            queue = getattr(io_loop, "_djangotornado_callbacks", None)
+            if queue is None:
+                queue = io_loop._djangotornado_callbacks = \
+                    CallbackQueue(io_loop)
+    queue.add_callback(callback)
+
+
+_current = local()
+
+def make_current(io_loop):
+    """Make io_loop the IOLoop of the calling thread"""
+    if hasattr(io_loop, "make_current"):
+        io_loop.make_current()
+    _current.io_loop = io_loop
+
+def current_io_loop():
+    """Return the IOLoop of the calling thread, the global one by default"""
+    io_loop = getattr(_current, "io_loop", None)
+    if io_loop is not None:
+        return io_loop
+    if hasattr(IOLoop, "current"):
+        return IOLoop.current()
+    return IOLoop.instance()
+
+def close_io_loop(io_loop):
+    """Release the file descriptors of a stopped IOLoop"""
+    queue = getattr(io_loop, "_djangotornado_callbacks", None)
+    if queue is not None:
+        queue.close()
+        io_loop._djangotornado_callbacks = None
+    if hasattr(io_loop, "close"):
+        io_loop.close()
+        return
+    # Tornado 2.0
+    io_loop.remove_handler(io_loop._waker_reader.fileno())
+    io_loop._waker_reader.close()
+    io_loop._waker_writer.close()
+    if hasattr(io_loop._impl, "close"):
+        io_loop._impl.close()
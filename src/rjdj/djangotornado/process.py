@@ -0,0 +1,144 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import os
+import sys
+import time
+import errno
+import random
+import signal
+import logging
+
+
+logger = logging.getLogger()
+
+_task_id = None
+
+def cpu_count():
+    """Return the number of processors on this machine"""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        pass
+    try:
+        return os.sysconf("SC_NPROCESSORS_CONF")
+    except ValueError:
+        pass
+    logger.error("Could not detect number of processors; assuming 1")
+    return 1
+
+def _reseed_random():
+    """Forked children must not share the parent's random sequence"""
+    try:
+        seed = long(os.urandom(16).encode("hex"), 16)
+    except NotImplementedError:
+        seed = int(time.time() * 1000) ^ os.getpid()
+    random.seed(seed)
+
+def task_id():
+    """Task id of this process if it was forked by `fork_workers`, else
+    None"""
+    return _task_id
+
+def fork_workers(num_processes, max_restarts=100):
+    """Fork ``num_processes`` worker processes and supervise them
+
+    Returns the task id (0 to num_processes - 1) in every child.  The
+    parent never returns: it restarts children that die from a signal
+    or exit with a non-zero status, forwards SIGTERM and SIGINT to all
+    children and exits once the last child is gone.
+
+    Sockets have to be bound before, and the IOLoop must not be created
+    until after calling this function.
+    """
+    if num_processes is None or num_processes <= 0:
+        num_processes = cpu_count()
+    logger.info("Pre-forking %d server processes", num_processes)
+
+    children = {}
+
+    def start_child(task_id):
+        global _task_id
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            _reseed_random()
+            _task_id = task_id
+            return task_id
+        children[pid] = task_id
+        return None
+
+    for i in range(num_processes):
+        task_id = start_child(i)
+        if task_id is not None:
+            return task_id
+
+    shutting_down = []
+
+    def shutdown(signum, frame):
+        shutting_down.append(signum)
+        for pid in children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    restarts = 0
+    exit_code = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid not in children:
+            continue
+        task_id = children.pop(pid)
+        if shutting_down:
+            continue
+        if os.WIFSIGNALED(status):
+            logger.warning("Child %d (pid %d) killed by signal %d, restarting",
+                           task_id, pid, os.WTERMSIG(status))
+        elif os.WEXITSTATUS(status) != 0:
+            logger.warning("Child %d (pid %d) exited with status %d, "
+                           "restarting", task_id, pid, os.WEXITSTATUS(status))
+        else:
+            logger.info("Child %d (pid %d) exited normally", task_id, pid)
+            continue
+        restarts += 1
+        if restarts > max_restarts:
+            logger.error("Too many child restarts, giving up")
+            exit_code = 1
+            shutdown(signal.SIGTERM, None)
+            continue
+        task_id = start_child(task_id)
+        if task_id is not None:
+            return task_id
+    sys.exit(exit_code)
@@ -0,0 +1,169 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import os
+import re
+import hmac
+import random
+import pstats
+import marshal
+import cProfile
+import logging
+
+from threading import Lock, Timer
+
+from django.conf import settings
+
+
+logger = logging.getLogger()
+
+
+def _equals(a, b):
+    """Compare secrets in constant time"""
+    if hasattr(hmac, "compare_digest"):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+class Profiler(object):
+    """Runs selected requests under cProfile
+
+    A request is profiled if its handler name is in ``handlers``, if it
+    carries the ``header`` with the ``secret`` as value, or by chance
+    with ``sample_rate``.  The stats of all profiled requests of a
+    handler are aggregated in memory and written to
+    ``<directory>/<name>.pstats`` by a timer thread ``dump_interval``
+    seconds after the first new profile, to be read with the pstats
+    module.
+    """
+
+    def __init__(self, directory, secret=None, sample_rate=0.0, handlers=(),
+                 header="X-Tornado-Profile", dump_interval=5.0):
+        self.directory = directory
+        self.secret = secret
+        self.sample_rate = sample_rate
+        self.handlers = frozenset(handlers)
+        self.header = header
+        self.dump_interval = dump_interval
+        self._stats = {}
+        self._dirty = set()
+        self._timer = None
+        self._lock = Lock()
+
+    def should_profile(self, name, request):
+        """Decide whether to profile the Tornado request"""
+        if name in self.handlers:
+            return True
+        if self.secret:
+            value = request.headers.get(self.header)
+            if value and _equals(str(value), str(self.secret)):
+                return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def runcall(self, name, func, *args, **kwargs):
+        """Call func under the profiler and add its stats to name's"""
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self.add(name, profile)
+
+    def add(self, name, profile):
+        """Add the stats of profile to name's and schedule writing them"""
+        profile_stats = pstats.Stats(profile)
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                self._stats[name] = profile_stats
+            else:
+                stats.add(profile_stats)
+            self._dirty.add(name)
+            if self._timer is None:
+                self._timer = Timer(self.dump_interval, self.dump)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def dump(self):
+        """Write the stats which changed since the last dump"""
+        with self._lock:
+            self._timer = None
+            dirty, self._dirty = self._dirty, set()
+            data = [(name, marshal.dumps(self._stats[name].stats))
+                    for name in dirty]
+        for name, stats in data:
+            try:
+                with open(self.path(name), "wb") as f:
+                    f.write(stats)
+            except (IOError, OSError):
+                logger.error("Could not write profile of %s", name,
+                             exc_info=True)
+
+    def path(self, name):
+        """Return the file the stats of handler name are written to"""
+        filename = re.sub(r"[^\w.-]", "_", str(name)) + ".pstats"
+        return os.path.join(self.directory, filename)
+
+
+_profiler = None
+_profiler_lock = Lock()
+
+def get_profiler():
+    """Return the profiler, None if profiling is disabled
+
+    Profiling is enabled by setting ``TORNADO_PROFILE_DIR`` and selecting
+    requests with ``TORNADO_PROFILE_HANDLERS`` (handler names),
+    ``TORNADO_PROFILE_SECRET`` (value of the ``X-Tornado-Profile``
+    request header, name set with ``TORNADO_PROFILE_HEADER``) or
+    ``TORNADO_PROFILE_SAMPLE_RATE`` (0 to 1).  The stats are written
+    ``TORNADO_PROFILE_DUMP_INTERVAL`` seconds (default 5) after new
+    profiles came in.
+    """
+    global _profiler
+    if _profiler is None:
+        with _profiler_lock:
+            if _profiler is None:
+                directory = getattr(settings, "TORNADO_PROFILE_DIR", None)
+                if directory:
+                    if not os.path.isdir(directory):
+                        os.makedirs(directory)
+                    _profiler = Profiler(
+                        directory,
+                        secret=getattr(settings, "TORNADO_PROFILE_SECRET",
+                                       None),
+                        sample_rate=getattr(
+                            settings, "TORNADO_PROFILE_SAMPLE_RATE", 0.0),
+                        handlers=getattr(settings, "TORNADO_PROFILE_HANDLERS",
+                                         ()),
+                        header=getattr(settings, "TORNADO_PROFILE_HEADER",
+                                       "X-Tornado-Profile"),
+                        dump_interval=getattr(
+                            settings, "TORNADO_PROFILE_DUMP_INTERVAL", 5.0))
+                else:
+                    _profiler = False
+    return _profiler or None
@@ -0,0 +1,199 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import gzip
+import hashlib
+import email.utils
+
+from cStringIO import StringIO
+
+from django.conf import settings
+
+
+GZIP_CONTENT_TYPES = frozenset([
+    "text/plain", "text/html", "text/css", "text/xml", "text/javascript",
+    "text/csv", "application/javascript", "application/x-javascript",
+    "application/json", "application/xml", "application/atom+xml",
+    "application/rss+xml", "application/xhtml+xml", "image/svg+xml"])
+
+
+class PreparedResponse(object):
+    """A Django response turned into status, headers and body bytes
+
+    Created by `prepare_response`, which does the expensive work (
+    rendering, hashing, compressing) so it can run outside the IOLoop.
+    """
+
+    __slots__ = ("status_code", "headers", "body", "cookies")
+
+    def __init__(self, status_code, headers, body, cookies=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.cookies = cookies
+
+    def get_header(self, name):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return None
+
+
+def _parse_http_date(value):
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+def is_not_modified(request_headers, etag, last_modified=None):
+    """True if the client's copy matches the ETag (or the Last-Modified
+    date if the client sent no If-None-Match header)"""
+    if_none_match = request_headers.get("If-None-Match")
+    if if_none_match:
+        if etag is None:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        # Weak comparison is fine for If-None-Match
+        etag = etag[2:] if etag.startswith("W/") else etag
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == etag:
+                return True
+        return False
+    if_modified_since = request_headers.get("If-Modified-Since")
+    if if_modified_since and last_modified:
+        since = _parse_http_date(if_modified_since)
+        modified = _parse_http_date(last_modified)
+        return since is not None and modified is not None and \
+               modified <= since
+    return False
+
+def not_modified(prepared):
+    """Turn a prepared response into a 304 response without body"""
+    headers = [(k, v) for k, v in prepared.headers
+               if k.lower() not in ("content-type", "content-length",
+                                    "content-encoding")]
+    return PreparedResponse(304, headers, "", prepared.cookies)
+
+def accepts_gzip(request_headers):
+    for coding in request_headers.get("Accept-Encoding", "").split(","):
+        coding = coding.strip().split(";")
+        if coding[0].strip() in ("gzip", "*"):
+            q = [p.strip()[2:] for p in coding[1:] if p.strip().startswith("q=")]
+            try:
+                return not q or float(q[0]) > 0
+            except ValueError:
+                return False
+    return False
+
+def compress(body, level=6):
+    """Gzip body; the output does not depend on the current time"""
+    out = StringIO()
+    gzip_file = gzip.GzipFile(mode="wb", fileobj=out,
+                              compresslevel=level, mtime=0)
+    gzip_file.write(body)
+    gzip_file.close()
+    return out.getvalue()
+
+def _should_compress(status_code, headers, body):
+    if not getattr(settings, "TORNADO_GZIP", True):
+        return False
+    if status_code != 200 or \
+       len(body) < getattr(settings, "TORNADO_GZIP_MIN_LENGTH", 1024):
+        return False
+    content_type = None
+    for k, v in headers:
+        name = k.lower()
+        if name == "content-encoding":
+            return False
+        if name == "content-type":
+            content_type = v.split(";")[0].strip().lower()
+    content_types = getattr(settings, "TORNADO_GZIP_CONTENT_TYPES",
+                            GZIP_CONTENT_TYPES)
+    return content_type in content_types
+
+def _add_vary(headers, header):
+    for i, (k, v) in enumerate(headers):
+        if k.lower() == "vary":
+            if header.lower() not in [h.strip().lower() for h in v.split(",")]:
+                headers[i] = (k, "%s, %s" % (v, header))
+            return
+    headers.append(("Vary", header))
+
+def prepare_response(response, request):
+    """Render a non-streaming Django response for a Tornado request
+
+    Successful GET and HEAD responses get a strong ETag (unless the view
+    set one) and are answered with 304 if the client's copy is still
+    valid; bodies of the allowed content types
+    (``TORNADO_GZIP_CONTENT_TYPES``) of at least
+    ``TORNADO_GZIP_MIN_LENGTH`` bytes are gzipped for clients accepting
+    it.  Gzip is turned off with ``TORNADO_GZIP = False``.
+    """
+    if hasattr(response, "render"):
+        response.render()
+    body = response.content
+    if isinstance(body, unicode):
+        body = body.encode("utf-8")
+    status_code = response.status_code
+    etag = last_modified = None
+    headers = []
+    for k, v in response.items():
+        k, v = k.encode("utf-8"), v.encode("utf-8")
+        name = k.lower()
+        if name == "etag":
+            etag = v
+            continue
+        if name == "last-modified":
+            last_modified = v
+        headers.append((k, v))
+    cookies = response.cookies or None
+
+    if status_code != 200 or request.method not in ("GET", "HEAD"):
+        if etag is not None:
+            headers.append(("Etag", etag))
+        return PreparedResponse(status_code, headers, body, cookies)
+
+    gzipped = _should_compress(status_code, headers, body)
+    if gzipped:
+        _add_vary(headers, "Accept-Encoding")
+        gzipped = accepts_gzip(request.headers)
+    if etag is None:
+        etag = '"%s%s"' % (hashlib.sha1(body).hexdigest(),
+                           "-gzip" if gzipped else "")
+    headers.append(("Etag", etag))
+
+    if is_not_modified(request.headers, etag, last_modified):
+        return not_modified(PreparedResponse(status_code, headers, body,
+                                             cookies))
+    if gzipped:
+        body = compress(body)
+        headers = [(k, v) for k, v in headers
+                   if k.lower() != "content-length"]
+        headers.append(("Content-Encoding", "gzip"))
+    return PreparedResponse(status_code, headers, body, cookies)
@@ -0,0 +1,209 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import os
+import stat
+import errno
+import fcntl
+import socket
+import logging
+import tempfile
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+from tornado import httpserver, ioloop, iostream
+
+from django.conf import settings
+
+
+class SpoolingHTTPConnection(httpserver.HTTPConnection):
+    """HTTP connection that streams large request bodies to a spool file
+
+    Bodies up to ``spool_threshold`` bytes are read into memory as
+    usual.  Larger bodies are read in chunks into a
+    ``SpooledTemporaryFile`` which is attached to the request as
+    ``body_file``; ``request.body`` stays empty and Tornado does not
+    parse the body arguments of such requests.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, stream, *args, **kwargs):
+        self.spool_threshold = kwargs.pop("spool_threshold")
+        max_body_size = kwargs.pop("max_body_size", None)
+        if max_body_size:
+            stream.max_buffer_size = max(stream.max_buffer_size, max_body_size)
+        # HTTPConnection reads the body with a single read_bytes() call
+        self._stream_read_bytes = stream.read_bytes
+        stream.read_bytes = self._read_body
+        super(SpoolingHTTPConnection, self).__init__(stream, *args, **kwargs)
+
+    def _read_body(self, num_bytes, callback):
+        if num_bytes <= self.spool_threshold:
+            return self._stream_read_bytes(num_bytes, callback)
+        self._spool = tempfile.SpooledTemporaryFile(
+            max_size=self.spool_threshold)
+        self._spool_remaining = num_bytes
+        self._read_chunk()
+
+    def _read_chunk(self):
+        self._stream_read_bytes(min(self.chunk_size, self._spool_remaining),
+                                self._on_body_chunk)
+
+    def _on_body_chunk(self, data):
+        self._spool.write(data)
+        self._spool_remaining -= len(data)
+        if self._spool_remaining > 0:
+            self._read_chunk()
+            return
+        spool, self._spool = self._spool, None
+        spool.seek(0)
+        self._request.body_file = spool
+        self.request_callback(self._request)
+
+    def _finish_request(self):
+        body_file = getattr(self._request, "body_file", None)
+        if body_file is not None:
+            body_file.close()
+        super(SpoolingHTTPConnection, self)._finish_request()
+
+
+_HTTPConnection = httpserver.HTTPConnection
+
+
+class DjangoHTTPServer(httpserver.HTTPServer):
+    """HTTPServer that optionally spools large request bodies
+
+    ``spool_threshold`` defaults to the Django setting
+    ``TORNADO_REQUEST_SPOOL_THRESHOLD`` (None disables spooling),
+    ``max_body_size`` to ``TORNADO_MAX_BODY_SIZE``.  Besides TCP ports
+    the server listens on unix sockets added with `bind_unix_socket`.
+    """
+
+    _unix_sockets = ()
+
+    def __init__(self, request_callback, spool_threshold=None,
+                 max_body_size=None, **kwargs):
+        super(DjangoHTTPServer, self).__init__(request_callback, **kwargs)
+        if spool_threshold is None:
+            spool_threshold = getattr(settings,
+                                      "TORNADO_REQUEST_SPOOL_THRESHOLD", None)
+        if max_body_size is None:
+            max_body_size = getattr(settings, "TORNADO_MAX_BODY_SIZE", None)
+        self.spool_threshold = spool_threshold
+        self.max_body_size = max_body_size
+
+    def bind_unix_socket(self, path, mode=0600):
+        """Listen on the unix socket ``path``, replacing a stale one"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        sock.setblocking(0)
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.remove(path)
+        except OSError:
+            pass
+        sock.bind(path)
+        os.chmod(path, mode)
+        sock.listen(128)
+        self._unix_sockets = self._unix_sockets + (path,)
+        if hasattr(self, "add_sockets"):
+            self.add_sockets([sock])
+            return
+        self._sockets[sock.fileno()] = sock
+        if self._started:
+            self.io_loop.add_handler(sock.fileno(), self._handle_events,
+                                     ioloop.IOLoop.READ)
+
+    def stop(self):
+        super(DjangoHTTPServer, self).stop()
+        for path in self._unix_sockets:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._unix_sockets = ()
+
+    def _connection(self, stream, address, *args, **kwargs):
+        if not address:
+            # Connections on unix sockets have no remote address
+            address = ("0.0.0.0", 0)
+        if self.spool_threshold is None:
+            return _HTTPConnection(stream, address, *args, **kwargs)
+        return SpoolingHTTPConnection(stream, address, *args,
+                                      spool_threshold=self.spool_threshold,
+                                      max_body_size=self.max_body_size,
+                                      **kwargs)
+
+    # Tornado 2.0 creates connections in _handle_events, later versions
+    # in handle_stream; both are overridden to create our connection
+    # class instead of swapping the module global of tornado.httpserver,
+    # which servers running in other threads may use at the same time.
+    if hasattr(httpserver.HTTPServer, "_handle_events"):
+        def _handle_events(self, fd, events):
+            while True:
+                try:
+                    connection, address = self._sockets[fd].accept()
+                except socket.error, e:
+                    if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                        return
+                    raise
+                if self.ssl_options is not None:
+                    try:
+                        connection = ssl.wrap_socket(
+                            connection, server_side=True,
+                            do_handshake_on_connect=False,
+                            **self.ssl_options)
+                    except ssl.SSLError, e:
+                        if e.args[0] == ssl.SSL_ERROR_EOF:
+                            return connection.close()
+                        raise
+                    except socket.error, e:
+                        if e.args[0] == errno.ECONNABORTED:
+                            return connection.close()
+                        raise
+                try:
+                    if self.ssl_options is not None:
+                        stream = iostream.SSLIOStream(connection,
+                                                      io_loop=self.io_loop)
+                    else:
+                        stream = iostream.IOStream(connection,
+                                                   io_loop=self.io_loop)
+                    self._connection(stream, address, self.request_callback,
+                                     self.no_keep_alive, self.xheaders)
+                except:
+                    logging.error("Error in connection callback",
+                                  exc_info=True)
+
+    if hasattr(httpserver.HTTPServer, "handle_stream"):
+        def handle_stream(self, stream, address):
+            args = (self.request_callback, self.no_keep_alive, self.xheaders)
+            if hasattr(self, "protocol"):
+                # Tornado 3.0 and later
+                args += (self.protocol,)
+            self._connection(stream, address, *args)
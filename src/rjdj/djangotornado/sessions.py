@@ -0,0 +1,115 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import copy
+import datetime
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousOperation
+from django.contrib.sessions.backends import db
+from django.utils.encoding import force_unicode
+
+try:
+    from django.utils.timezone import now
+except ImportError:
+    now = datetime.datetime.now
+
+from rjdj.djangotornado.cache import get_session_cache
+from rjdj.djangotornado import process
+
+
+class SessionStore(db.SessionStore):
+    """Database sessions cached in the server process
+
+    Enabled with ``SESSION_ENGINE = "rjdj.djangotornado.sessions"``.
+    Decoded sessions are kept in an LRU cache keyed by the session key,
+    so requests of known sessions need no query.  Saving writes through
+    to the database and updates the cache, deleting evicts the session.
+
+    Other server processes do not see these updates, so cached sessions
+    are reloaded after ``TORNADO_SESSION_CACHE_TTL`` seconds (None to
+    keep them until they expire); a session deleted in one process
+    (e.g. by logging out) stays valid that long in the others.  The
+    default is 60 seconds for a single process; with several processes
+    (``TORNADO_PROCESSES`` other than 1, or forked by runtornado) it is
+    0, which disables the cache unless a TTL is set explicitly.
+    """
+
+    def load(self):
+        cache = get_session_cache()
+        if self._session_key is not None:
+            entry = cache.get(self.session_key)
+            if entry is not None:
+                data, expire_date = entry
+                if expire_date > now():
+                    # Views change the session in place
+                    return copy.deepcopy(data)
+                cache.delete(self.session_key)
+        try:
+            s = db.Session.objects.get(session_key=self.session_key,
+                                       expire_date__gt=now())
+            data = self.decode(force_unicode(s.session_data))
+        except (db.Session.DoesNotExist, SuspiciousOperation):
+            self.create()
+            return {}
+        self._cache_session(self.session_key, data, s.expire_date)
+        return data
+
+    def exists(self, session_key):
+        if get_session_cache().get(session_key) is not None:
+            return True
+        return super(SessionStore, self).exists(session_key)
+
+    def save(self, must_create=False):
+        super(SessionStore, self).save(must_create)
+        self._cache_session(self.session_key,
+                            self._get_session(no_load=must_create),
+                            self.get_expiry_date())
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            session_key = self._session_key
+        super(SessionStore, self).delete(session_key)
+        if session_key is not None:
+            get_session_cache().delete(session_key)
+
+    def _cache_session(self, session_key, data, expire_date):
+        ttl = cache_ttl()
+        if ttl == 0:
+            return
+        get_session_cache().set(session_key,
+                                (copy.deepcopy(data), expire_date), 1, ttl)
+
+
+def cache_ttl():
+    """Seconds sessions stay cached, None for no limit, 0 for none"""
+    try:
+        return settings.TORNADO_SESSION_CACHE_TTL
+    except AttributeError:
+        pass
+    if process.task_id() is not None or \
+       getattr(settings, "TORNADO_PROCESSES", 1) != 1:
+        return 0
+    return 60
+
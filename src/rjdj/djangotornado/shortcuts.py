@@ -22,28 +22,51 @@
 
 __docformat__ = "reStructuredText"
 
-from threading import Lock
-
 current_application = None
-lock = Lock()
+
+# (application, named specs, URLs of the specs without arguments); set
+# with a single assignment, so readers never need a lock
+_routes = (None, {}, {})
+
+def _compile_routes(app):
+    """Returns the named specs of ``app`` and the URLs of those which
+    take no arguments"""
+    specs = dict(app.named_handlers)
+    static_urls = {}
+    for name, spec in specs.iteritems():
+        if spec._path is not None and not spec._group_count:
+            static_urls[name] = spec.reverse()
+    return specs, static_urls
 
 def set_application(app):
-    global lock
     global current_application
-    
-    lock.acquire()
+    global _routes
+
+    if app is None:
+        specs, static_urls = {}, {}
+    else:
+        specs, static_urls = _compile_routes(app)
+    _routes = (app, specs, static_urls)
     current_application = app
-    lock.release()
 
 def reverse(handler_name, *args):
     """ Shortcuts the reverse lookup of views in the application """
-    global current_application
+    app, specs, static_urls = _routes
 
-    if not current_application:
+    if not app:
         raise ValueError("No application found!")
     if not isinstance(handler_name,str):
         try:
             handler_name = handler_name.__name__
         except AttributeError:
             raise KeyError('%s not found in named urls' % handler_name)
-    return current_application.reverse_url(handler_name, *args)
+    if not args:
+        try:
+            return static_urls[handler_name]
+        except KeyError:
+            pass
+    spec = specs.get(handler_name)
+    if spec is None:
+        # Handlers may have been added after set_application()
+        return app.reverse_url(handler_name, *args)
+    return spec.reverse(*args)
@@ -0,0 +1,212 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import os
+import time
+import hashlib
+import datetime
+import mimetypes
+import email.utils
+
+from threading import Lock
+
+from tornado.web import StaticFileHandler, HTTPError
+
+from django.conf import settings
+
+from rjdj.djangotornado.cache import LRUCache
+from rjdj.djangotornado.responses import is_not_modified, accepts_gzip
+
+
+# Far-future expiry for fingerprinted URLs (ten years)
+FAR_FUTURE = 86400 * 365 * 10
+
+
+class StaticFile(object):
+    """Content and metadata of a file in the `StaticFileCache`"""
+
+    __slots__ = ("body", "mtime", "size", "etag", "last_modified",
+                 "fingerprint", "checked", "has_gzip")
+
+    def __init__(self, body, mtime, size, has_gzip=False):
+        self.body = body
+        self.mtime = mtime
+        self.size = size
+        digest = hashlib.sha1(body).hexdigest()
+        self.etag = '"%s"' % digest
+        self.fingerprint = digest[:12]
+        self.last_modified = email.utils.formatdate(mtime, usegmt=True)
+        self.checked = time.time()
+        self.has_gzip = has_gzip
+
+
+class StaticFileCache(object):
+    """Keeps static files in memory
+
+    Files larger than ``max_file_size`` are not cached.  Cached files are
+    checked for changes on disk, and for a precompressed ``<file>.gz``
+    next to them, at most every ``check_interval`` seconds.
+    """
+
+    def __init__(self, max_size, max_file_size, check_interval=2.0):
+        self.entries = LRUCache(max_size)
+        self.max_file_size = max_file_size
+        self.check_interval = check_interval
+
+    def get(self, abspath):
+        """Return the `StaticFile` for abspath, None if it is too large
+
+        Raises OSError or IOError if the file cannot be read.
+        """
+        entry = self.entries.get(abspath)
+        if entry is not None:
+            if time.time() - entry.checked < self.check_interval:
+                return entry
+            stat_result = os.stat(abspath)
+            if (stat_result.st_mtime, stat_result.st_size) == \
+               (entry.mtime, entry.size):
+                entry.has_gzip = os.path.exists(abspath + ".gz")
+                entry.checked = time.time()
+                return entry
+        stat_result = os.stat(abspath)
+        if stat_result.st_size > self.max_file_size:
+            return None
+        with open(abspath, "rb") as f:
+            body = f.read()
+        entry = StaticFile(body, stat_result.st_mtime, stat_result.st_size,
+                           os.path.exists(abspath + ".gz"))
+        self.entries.set(abspath, entry, len(body))
+        return entry
+
+    def stats(self):
+        return self.entries.stats()
+
+
+_cache = None
+_cache_lock = Lock()
+
+def get_static_file_cache():
+    """Return the shared static file cache, created on first use
+
+    Configured with the Django settings ``TORNADO_STATIC_CACHE_SIZE``
+    (default 32 MB), ``TORNADO_STATIC_MAX_FILE_SIZE`` (default 1 MB) and
+    ``TORNADO_STATIC_CHECK_INTERVAL`` (default 2 seconds).
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = StaticFileCache(
+                    getattr(settings, "TORNADO_STATIC_CACHE_SIZE",
+                            32 * 1024 * 1024),
+                    getattr(settings, "TORNADO_STATIC_MAX_FILE_SIZE",
+                            1024 * 1024),
+                    getattr(settings, "TORNADO_STATIC_CHECK_INTERVAL", 2.0))
+    return _cache
+
+
+class CachedStaticFileHandler(StaticFileHandler):
+    """StaticFileHandler serving files from memory
+
+    Clients accepting gzip get the precompressed ``<file>.gz`` if it
+    exists next to the file.  URLs carrying the file's fingerprint in
+    the ``v`` argument (see `static_url`) are cached by clients for ten
+    years, all others are revalidated with ETag and Last-Modified.
+    Files too large for the cache are served like by Tornado's
+    StaticFileHandler.
+    """
+
+    def get(self, path, include_body=True):
+        abspath = self._resolve(path)
+        if abspath is None:
+            return
+        cache = get_static_file_cache()
+        entry = cache.get(abspath)
+        if entry is None:
+            return super(CachedStaticFileHandler, self).get(path, include_body)
+
+        mime_type, encoding = mimetypes.guess_type(abspath)
+        if mime_type:
+            self.set_header("Content-Type", mime_type)
+        body = entry.body
+        etag = entry.etag
+        if entry.has_gzip:
+            self.set_header("Vary", "Accept-Encoding")
+            if accepts_gzip(self.request.headers):
+                gzipped = cache.get(abspath + ".gz")
+                if gzipped is not None and gzipped.mtime >= entry.mtime:
+                    body = gzipped.body
+                    etag = gzipped.etag
+                    self.set_header("Content-Encoding", "gzip")
+
+        if self.get_argument("v", None) == entry.fingerprint:
+            self.set_header("Expires", datetime.datetime.utcnow() +
+                                       datetime.timedelta(seconds=FAR_FUTURE))
+            self.set_header("Cache-Control", "public, max-age=%d" % FAR_FUTURE)
+        else:
+            self.set_header("Cache-Control", "public")
+        self.set_header("Last-Modified", entry.last_modified)
+        self.set_header("Etag", etag)
+        self.set_extra_headers(path)
+
+        if is_not_modified(self.request.headers, etag, entry.last_modified):
+            self.set_status(304)
+            return
+        if include_body:
+            self.write(body)
+        else:
+            self.set_header("Content-Length", len(body))
+
+    def _resolve(self, path):
+        """Return the absolute path of the requested file (like Tornado's
+        StaticFileHandler does)"""
+        if os.path.sep != "/":
+            path = path.replace("/", os.path.sep)
+        root = os.path.abspath(self.root) + os.path.sep
+        abspath = os.path.abspath(os.path.join(root, path))
+        if not (abspath + os.path.sep).startswith(root):
+            raise HTTPError(403, "%s is not in root static directory", path)
+        if os.path.isdir(abspath) and self.default_filename is not None:
+            if not self.request.path.endswith("/"):
+                self.redirect(self.request.path + "/")
+                return None
+            abspath = os.path.join(abspath, self.default_filename)
+        if not os.path.exists(abspath):
+            raise HTTPError(404)
+        if not os.path.isfile(abspath):
+            raise HTTPError(403, "%s is not a file", path)
+        return abspath
+
+    @classmethod
+    def static_url(cls, url_prefix, root, path):
+        """Return the fingerprinted URL of the file ``path`` below ``root``
+
+        Use it to link assets from templates; clients cache these URLs
+        forever and get a new URL as soon as the file changes.
+        """
+        entry = get_static_file_cache().get(os.path.join(root, path))
+        url = url_prefix + path
+        if entry is None:
+            return url
+        return "%s?v=%s" % (url, entry.fingerprint)
@@ -0,0 +1,270 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import json
+import time
+import bisect
+import logging
+
+from threading import Lock
+
+from tornado.ioloop import IOLoop
+from tornado.web import RequestHandler
+
+
+logger = logging.getLogger()
+
+# Cache stats which only ever grow
+CACHE_COUNTERS = ("hits", "misses", "evictions")
+
+# Database pool stats which only ever grow
+DB_POOL_COUNTERS = ("waits", "wait_time")
+
+# Upper bounds of the latency buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0)
+
+
+class Histogram(object):
+    """Counts observed values in fixed buckets (like Prometheus does)"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._lock = Lock()
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        """Return count, sum and the cumulative bucket counts"""
+        with self._lock:
+            counts = list(self._counts)
+            count, total = self.count, self.sum
+        cumulative = []
+        running = 0
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+            running += bucket_count
+            cumulative.append((bound, running))
+        return {"count": count, "sum": total, "buckets": cumulative}
+
+
+class HandlerStats(object):
+    """Requests, errors and latencies of one handler"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+    def record(self, status_code, duration):
+        self.requests += 1
+        if status_code >= 500:
+            self.errors += 1
+        self.latency.observe(duration)
+
+    def snapshot(self):
+        return {"requests": self.requests,
+                "errors": self.errors,
+                "latency": self.latency.snapshot()}
+
+
+class Stats(object):
+    """Runtime metrics of the server process"""
+
+    def __init__(self):
+        self.handlers = {}
+        self.queue_wait = Histogram()
+        self.ioloop_lag = Histogram()
+        self.started = time.time()
+        self._lock = Lock()
+
+    def record_request(self, name, status_code, duration):
+        handler_stats = self.handlers.get(name)
+        if handler_stats is None:
+            with self._lock:
+                handler_stats = self.handlers.setdefault(name, HandlerStats())
+        handler_stats.record(status_code, duration)
+
+    def snapshot(self):
+        """Return all metrics as a dictionary"""
+        from rjdj.djangotornado.pool import worker_pool_stats
+        from rjdj.djangotornado.db import get_connection_pools
+        from rjdj.djangotornado.cache import (get_response_cache,
+                                              session_cache_stats)
+        snapshot = {
+            "uptime": time.time() - self.started,
+            "handlers": dict((name, handler_stats.snapshot())
+                             for name, handler_stats in self.handlers.items()),
+            "queue_wait": self.queue_wait.snapshot(),
+            "ioloop_lag": self.ioloop_lag.snapshot(),
+            "response_cache": get_response_cache().stats(),
+            }
+        workers = worker_pool_stats()
+        if workers is not None:
+            snapshot["workers"] = workers
+        pools = get_connection_pools()
+        if pools is not None:
+            snapshot["db_pools"] = pools.stats()
+        session_cache = session_cache_stats()
+        if session_cache is not None:
+            snapshot["session_cache"] = session_cache
+        return snapshot
+
+
+_stats = Stats()
+
+def get_stats():
+    """Return the metrics of this process"""
+    return _stats
+
+def handler_name(handler):
+    """Name under which the requests of handler are recorded"""
+    return getattr(handler, "stats_name", None) or handler.__class__.__name__
+
+def record_request(handler):
+    """Record a finished request of a Tornado handler"""
+    _stats.record_request(handler_name(handler), handler.get_status(),
+                          handler.request.request_time())
+
+
+class IOLoopMonitor(object):
+    """Measures how late the IOLoop runs a timeout scheduled every
+    ``interval`` seconds"""
+
+    def __init__(self, io_loop=None, interval=0.5, stats=None):
+        self.io_loop = io_loop or IOLoop.instance()
+        self.interval = interval
+        self.stats = stats or _stats
+        self._timeout = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule(self):
+        deadline = time.time() + self.interval
+        self._timeout = self.io_loop.add_timeout(
+            deadline, lambda: self._check(deadline))
+
+    def _check(self, deadline):
+        self.stats.ioloop_lag.observe(max(0.0, time.time() - deadline))
+        self._schedule()
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+                     .replace("\n", "\\n")
+
+def _histogram_lines(name, snapshot, labels=""):
+    lines = []
+    separator = "," if labels else ""
+    for bound, count in snapshot["buckets"]:
+        lines.append('%s_bucket{%s%sle="%s"} %d' % (
+            name, labels, separator, bound, count))
+    braces = "{%s}" % labels if labels else ""
+    lines.append("%s_sum%s %r" % (name, braces, snapshot["sum"]))
+    lines.append("%s_count%s %d" % (name, braces, snapshot["count"]))
+    return lines
+
+def _cache_lines(name, stats):
+    lines = []
+    for key, value in sorted(stats.items()):
+        if key in CACHE_COUNTERS:
+            lines.append("# TYPE %s_%s_total counter" % (name, key))
+            lines.append("%s_%s_total %d" % (name, key, value))
+        else:
+            lines.append("# TYPE %s_%s gauge" % (name, key))
+            lines.append("%s_%s %d" % (name, key, value))
+    return lines
+
+def prometheus_text(snapshot):
+    """Format a `Stats.snapshot` in the Prometheus text format"""
+    lines = []
+    handlers = sorted(snapshot["handlers"].items())
+    lines.append("# TYPE tornado_requests_total counter")
+    for name, handler_stats in handlers:
+        lines.append('tornado_requests_total{handler="%s"} %d' % (
+            _escape_label(name), handler_stats["requests"]))
+    lines.append("# TYPE tornado_request_errors_total counter")
+    for name, handler_stats in handlers:
+        lines.append('tornado_request_errors_total{handler="%s"} %d' % (
+            _escape_label(name), handler_stats["errors"]))
+    lines.append("# TYPE tornado_request_duration_seconds histogram")
+    for name, handler_stats in handlers:
+        lines.extend(_histogram_lines(
+            "tornado_request_duration_seconds", handler_stats["latency"],
+            'handler="%s"' % _escape_label(name)))
+    lines.append("# TYPE tornado_worker_queue_wait_seconds histogram")
+    lines.extend(_histogram_lines("tornado_worker_queue_wait_seconds",
+                                  snapshot["queue_wait"]))
+    lines.append("# TYPE tornado_ioloop_lag_seconds histogram")
+    lines.extend(_histogram_lines("tornado_ioloop_lag_seconds",
+                                  snapshot["ioloop_lag"]))
+    for key, value in sorted(snapshot.get("workers", {}).items()):
+        lines.append("# TYPE tornado_worker_%s gauge" % key)
+        lines.append("tornado_worker_%s %d" % (key, value))
+    lines.extend(_cache_lines("tornado_response_cache",
+                              snapshot["response_cache"]))
+    lines.extend(_cache_lines("tornado_session_cache",
+                              snapshot.get("session_cache", {})))
+    db_pools = sorted(snapshot.get("db_pools", {}).items())
+    if db_pools:
+        for key in sorted(db_pools[0][1]):
+            if key in DB_POOL_COUNTERS:
+                name = "tornado_db_pool_%s_total" % key
+                lines.append("# TYPE %s counter" % name)
+            else:
+                name = "tornado_db_pool_%s" % key
+                lines.append("# TYPE %s gauge" % name)
+            for alias, pool_stats in db_pools:
+                lines.append('%s{database="%s"} %r' % (
+                    name, _escape_label(alias), pool_stats[key]))
+    lines.append("# TYPE tornado_uptime_seconds gauge")
+    lines.append("tornado_uptime_seconds %r" % snapshot["uptime"])
+    return "\n".join(lines) + "\n"
+
+
+class StatsHandler(RequestHandler):
+    """Serves the metrics as JSON, or in the Prometheus text format with
+    ``?format=prometheus``"""
+
+    def get(self):
+        snapshot = get_stats().snapshot()
+        if self.get_argument("format", None) == "prometheus":
+            self.set_header("Content-Type", "text/plain; version=0.0.4")
+            self.write(prometheus_text(snapshot))
+        else:
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps(snapshot, sort_keys=True))
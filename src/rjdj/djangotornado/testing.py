@@ -22,15 +22,25 @@
 
 __docformat__ = "reStructuredText"
 
+import os
+import sys
+import base64
+import socket
+import struct
 import urllib2
 import urllib
+import httplib
+import urlparse
 import threading
 
-from tornado import ioloop, httpserver
+import tornado
+
+from tornado import ioloop
 from tornado.httpclient import HTTPClient, HTTPRequest
 from tornado.web import RequestHandler
 
 from rjdj.djangotornado.patches import DjangoApplication
+from rjdj.djangotornado.server import DjangoHTTPServer
 from rjdj.djangotornado.signals import tornado_exit
 from rjdj.djangotornado.utils import get_named_urlspecs
 
@@ -38,6 +48,7 @@ from poster.encode import multipart_encode
 from poster.streaminghttp import register_openers
 
 from rjdj.djangotornado.shortcuts import set_application
+from rjdj.djangotornado.pool import make_current, close_io_loop
 
 class TestResponse(object):
     """Wrapper for urllib repsonse"""
@@ -80,25 +91,50 @@ class TestResponseHandler(urllib2.BaseHandler):
     def general_response(self, req, page, code, msg, hdrs):
         return page
 
-    http_error_400 = http_error_404 = http_error_405 = http_error_500 = general_response
+    http_error_304 = http_error_400 = http_error_404 = http_error_405 = \
+        http_error_500 = general_response
+
 
 
+class TestServer(DjangoHTTPServer):
+    """Test Server for Tornado
 
-class TestServer(httpserver.HTTPServer):
-    """Test Server for Tornado"""
+    Every test server runs its own IOLoop (unless one is passed in) and
+    listens on an ephemeral port of ``address``, chosen when the server
+    is created, or on the unix socket ``unix_socket``. So any number of
+    test servers (and test processes) can run side by side.
+    """
 
-    port = 10000
+    port = None
     address = "localhost"
+    unix_socket = None
     _io_thread = None
     _started = False
+    _bound = False
 
-    def __init__(self, handlers, io_loop=None):
+    def __init__(self, handlers, io_loop=None, port=None, unix_socket=None):
 
         application = DjangoApplication(get_named_urlspecs(handlers))
-        io_loop = io_loop or ioloop.IOLoop.instance()
+        self._own_io_loop = io_loop is None
+        io_loop = io_loop or ioloop.IOLoop()
         super(TestServer, self).__init__(application, io_loop=io_loop)
         set_application(application)
-
+        if port is not None:
+            self.port = port
+        if unix_socket is not None:
+            self.unix_socket = unix_socket
+        self._bind()
+
+    def _bind(self):
+        if self.unix_socket:
+            self.bind_unix_socket(self.unix_socket)
+        else:
+            self.bind(self.port or 0, address=self.address,
+                      family=socket.AF_INET)
+            sockets = (list(self._sockets.values()) +
+                       list(getattr(self, "_pending_sockets", [])))
+            self.port = sockets[0].getsockname()[1]
+        self._bound = True
 
     def start(self):
         raise Exception("""You are not allowed to spawn a test server
@@ -109,19 +145,20 @@ Use 'testserver.run()' instead!
 
     def run(self):
         """Start in background"""
-        assert not self._sockets
         if not self._started:
             if not self.io_loop.running():
                 self._io_thread = threading.Thread(target=self._run_background)
                 self._io_thread.daemon = True
                 self._io_thread.start()
-            self.bind(self.port, address=self.address)
+            if not self._bound:
+                self._bind()
             super(TestServer, self).start()
             self._started = True
         else:
             print "Nothing to do. Server already started."
 
     def _run_background(self):
+        make_current(self.io_loop)
         self.io_loop.start()
 
     def update_app(self, handlers):
@@ -138,6 +175,7 @@ Use 'testserver.run()' instead!
             self.stop()
             self._sockets = {}
             self._started = False
+            self._bound = False
             
             # send exit signal
             tornado_exit.send_robust(sender = self)
@@ -146,20 +184,258 @@ Use 'testserver.run()' instead!
         print "Kill IOLoop thread: %s " % self._io_thread
         print "Kill current thread: %s" % threading.current_thread()
         self._stop()
-
+        if self._bound:
+            self.stop()
+            self._bound = False
+        if getattr(self, "_own_io_loop", False):
+            self._own_io_loop = False
+            close_io_loop(self.io_loop)
+
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """HTTP connection over a unix socket"""
+
+    def __init__(self, path, timeout=30):
+        httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP/1.1 connections to a TestServer
+
+    Connects to ``unix_socket`` instead of host and port if given.
+    """
+
+    def __init__(self, host, port, timeout=30, unix_socket=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.unix_socket = unix_socket
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def request(self, method, uri, body=None, headers={}):
+        """Send a request, return status, headers and content"""
+        while True:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            reused = connection is not None
+            if connection is None:
+                connection = self._connect()
+            try:
+                connection.request(method, uri, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if reused:
+                    # The server closed the idle connection, try another
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                with self._lock:
+                    self._idle.append(connection)
+            return response.status, response.msg.dict, content
+
+    def _connect(self):
+        if self.unix_socket:
+            return UnixHTTPConnection(self.unix_socket, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class SocketTestClient(object):
+    """Raw socket connection to a test server with a read buffer"""
+
+    def __init__(self, host, port, unix_socket=None, timeout=5):
+        if unix_socket:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(unix_socket)
+        else:
+            self.sock = socket.create_connection((host, port), timeout)
+        self._buffer = ""
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        self._buffer += data
+        return bool(data)
+
+    def _read_until(self, delimiter):
+        while delimiter not in self._buffer:
+            if not self._fill():
+                return None
+        data, self._buffer = self._buffer.split(delimiter, 1)
+        return data
+
+    def _read_bytes(self, length):
+        while len(self._buffer) < length:
+            if not self._fill():
+                return None
+        data, self._buffer = self._buffer[:length], self._buffer[length:]
+        return data
+
+    def close(self):
+        self.sock.close()
+
+
+class WebSocketTestClient(SocketTestClient):
+    """Blocking WebSocket client for tests
+
+    Speaks RFC 6455, or draft 76 with Tornado 2.0, which knows no other
+    version of the protocol.
+    """
+
+    def __init__(self, host, port, uri, headers={}, unix_socket=None,
+                 timeout=5):
+        super(WebSocketTestClient, self).__init__(host, port, unix_socket,
+                                                  timeout)
+        self.draft76 = tornado.version_info < (2, 1)
+        request = ["GET %s HTTP/1.1" % uri,
+                   "Host: %s:%s" % (host, port),
+                   "Origin: http://%s:%s" % (host, port)]
+        if self.draft76:
+            request += ["Upgrade: WebSocket", "Connection: Upgrade",
+                        "Sec-WebSocket-Key1: 4 2", "Sec-WebSocket-Key2: 1 8"]
+        else:
+            request += ["Upgrade: websocket", "Connection: Upgrade",
+                        "Sec-WebSocket-Key: %s" %
+                            base64.b64encode(os.urandom(16)),
+                        "Sec-WebSocket-Version: 13"]
+        request += ["%s: %s" % item for item in headers.items()]
+        self.sock.sendall("\r\n".join(request) + "\r\n\r\n" +
+                          ("12345678" if self.draft76 else ""))
+        status = self._read_until("\r\n\r\n") or ""
+        if " 101 " not in status.split("\r\n")[0]:
+            raise IOError("WebSocket handshake failed: %s" %
+                          status.split("\r\n")[0])
+        if self.draft76:
+            self._read_bytes(16)
+
+    def send(self, message):
+        if isinstance(message, unicode):
+            message = message.encode("utf-8")
+        if self.draft76:
+            self.sock.sendall("\x00" + message + "\xff")
+            return
+        length = len(message)
+        if length < 126:
+            header = struct.pack("BB", 0x81, 0x80 | length)
+        elif length <= 0xFFFF:
+            header = struct.pack("!BBH", 0x81, 0x80 | 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x81, 0x80 | 127, length)
+        mask = os.urandom(4)
+        masked = "".join(chr(ord(c) ^ ord(mask[i % 4]))
+                         for i, c in enumerate(message))
+        self.sock.sendall(header + mask + masked)
+
+    def receive(self):
+        """Return the next message, None once the server closed"""
+        if self.draft76:
+            if self._read_bytes(1) != "\x00":
+                return None
+            message = self._read_until("\xff")
+            return message.decode("utf-8") if message is not None else None
+        header = self._read_bytes(2)
+        if header is None:
+            return None
+        opcode, length = ord(header[0]) & 0x0f, ord(header[1]) & 0x7f
+        if length == 126:
+            length = struct.unpack("!H", self._read_bytes(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._read_bytes(8))[0]
+        payload = self._read_bytes(length)
+        if opcode == 0x8 or payload is None:
+            return None
+        if opcode == 0x1:
+            return payload.decode("utf-8")
+        return payload
+
+
+class EventStreamTestClient(SocketTestClient):
+    """Blocking Server-Sent Events client for tests
+
+    Uses HTTP/1.0, so the events arrive without chunked encoding.
+    """
+
+    def __init__(self, host, port, uri, headers={}, unix_socket=None,
+                 timeout=5):
+        super(EventStreamTestClient, self).__init__(host, port, unix_socket,
+                                                    timeout)
+        request = ["GET %s HTTP/1.0" % uri,
+                   "Host: %s:%s" % (host, port),
+                   "Accept: text/event-stream"]
+        request += ["%s: %s" % item for item in headers.items()]
+        self.sock.sendall("\r\n".join(request) + "\r\n\r\n")
+        head = (self._read_until("\r\n\r\n") or "").split("\r\n")
+        self.status_code = int(head[0].split(" ")[1])
+        self.headers = dict((k.lower(), v.strip()) for k, v in
+                            (line.split(":", 1) for line in head[1:]))
+        self.comments = 0
+
+    def receive(self):
+        """Return the fields of the next event as a dict, None once the
+        stream has ended; comments (heartbeats) are counted"""
+        while True:
+            block = self._read_until("\n\n")
+            if block is None:
+                return None
+            event = {}
+            for line in block.split("\n"):
+                if line.startswith(":"):
+                    self.comments += 1
+                    continue
+                field, _, value = line.partition(":")
+                value = value[1:] if value.startswith(" ") else value
+                if field == "data" and "data" in event:
+                    value = event["data"] + "\n" + value
+                event[field] = value
+            if event:
+                return event
 
 
 class TestClient(object):
-    """Test Client for Tornado"""
+    """Test Client for Tornado
+
+    By default the test server is started and stopped around every
+    request. With ``keep_alive=True`` it runs until `close` is called
+    (or the ``with`` block is left, which implies ``keep_alive``) and
+    requests reuse pooled HTTP/1.1 connections.  With ``unix_socket``
+    the server listens on that unix socket instead of a TCP port.
+    """
 
     _server = None
+    _pool = None
+
+    redirect_codes = (301, 302, 303, 307)
+    max_redirects = 10
 
-    def __init__(self, handlers, io_loop=None):
-        self._server = TestServer(handlers, io_loop)
+    def __init__(self, handlers, io_loop=None, keep_alive=False,
+                 unix_socket=None):
+        self._server = TestServer(handlers, io_loop, unix_socket=unix_socket)
+        self.keep_alive = keep_alive
 
     def get_url(self, uri, protocol="http"):
         if not (type(protocol) == str or type(protocol) == unicode):
             raise TypeError("Protocol must be string or unicode.")
+        if self._server.unix_socket:
+            return str("%s://%s%s" % (protocol, self._server.address, uri))
         return str("%s://%s:%d%s" % (
             protocol,
             self._server.address,
@@ -190,6 +466,16 @@ class TestClient(object):
                 data = urllib.urlencode({})
 
 
+        headers.update(options.get("headers", {}))
+        if self.keep_alive:
+            return self._fetch_pooled(method, uri, data, headers)
+        if self._server.unix_socket:
+            # urllib2 cannot connect to unix sockets
+            self.start()
+            try:
+                return self._fetch_pooled(method, uri, data, headers)
+            finally:
+                self.close()
         opener = opener or urllib2.build_opener()
         opener.add_handler(TestResponseHandler())
         try:
@@ -201,6 +487,119 @@ class TestClient(object):
             self._server._stop()
         return TestResponse(response.code, content, response.headers.dict)
 
+    def _fetch_pooled(self, method, uri, data, headers):
+        """Fetch through the connection pool of the running server
+
+        Behaves like the urllib2 opener: redirects are followed, and
+        error codes TestResponseHandler does not handle raise HTTPError.
+        """
+        self.start()
+        if data is not None and not isinstance(data, basestring):
+            # multipart_encode returns a generator
+            data = "".join(data)
+        if data is not None and method == "POST":
+            headers.setdefault("Content-Type",
+                               "application/x-www-form-urlencoded")
+        for i in range(self.max_redirects + 1):
+            status, response_headers, content = self._pool.request(
+                method, uri, data, headers)
+            if status not in self.redirect_codes:
+                break
+            location = urlparse.urlsplit(response_headers["location"])
+            uri = urlparse.urlunsplit(("", "") + location[2:])
+            if status != 307:
+                method, data = "GET", None
+                headers.pop("Content-Type", None)
+        handled = [int(name[len("http_error_"):])
+                   for name in dir(TestResponseHandler)
+                   if name.startswith("http_error_")]
+        if status >= 400 and status not in handled:
+            raise urllib2.HTTPError(self.get_url(uri), status, content,
+                                    response_headers, None)
+        return TestResponse(status, content, response_headers)
+
+    def websocket(self, uri, headers={}):
+        """Open a `WebSocketTestClient`; needs a ``keep_alive`` client"""
+        if not self.keep_alive:
+            raise ValueError("websocket needs a keep_alive TestClient")
+        self.start()
+        return WebSocketTestClient(self._server.address, self._server.port,
+                                   uri, headers, self._server.unix_socket)
+
+    def events(self, uri, headers={}):
+        """Open an `EventStreamTestClient`; needs a ``keep_alive`` client"""
+        if not self.keep_alive:
+            raise ValueError("events needs a keep_alive TestClient")
+        self.start()
+        return EventStreamTestClient(self._server.address, self._server.port,
+                                     uri, headers, self._server.unix_socket)
+
+    def fetch_many(self, requests, concurrency=10):
+        """Send requests concurrently, return the responses in order
+
+        A request is a tuple of the arguments of `fetch`, e.g.
+        ``(method, uri, data)``, or a dict of its keyword arguments. The
+        first exception of a request is raised once all requests are
+        done. Needs a ``keep_alive`` client.
+        """
+        if not self.keep_alive:
+            raise ValueError("fetch_many needs a keep_alive TestClient")
+        self.start()
+        requests = list(requests)
+        results = [None] * len(requests)
+        errors = []
+        pending = iter(range(len(requests)))
+        lock = threading.Lock()
+
+        def run():
+            while True:
+                with lock:
+                    index = next(pending, None)
+                if index is None:
+                    return
+                request = requests[index]
+                try:
+                    if isinstance(request, dict):
+                        results[index] = self.fetch(**request)
+                    else:
+                        results[index] = self.fetch(*request)
+                except Exception:
+                    errors.append((index, sys.exc_info()))
+
+        threads = [threading.Thread(target=run)
+                   for i in range(min(concurrency, len(requests)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            exc_info = min(errors)[1]
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return results
+
+    def start(self):
+        """Start the server of a keep_alive client (done on first fetch)"""
+        if self._pool is None:
+            self._server.run()
+            self._pool = ConnectionPool(self._server.address,
+                                        self._server.port,
+                                        unix_socket=self._server.unix_socket)
+
+    def close(self):
+        """Close the pooled connections and stop the server"""
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            pool.close()
+            self._server._stop()
+
+    def __enter__(self):
+        self.keep_alive = True
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def get(self, uri, data=None, **options):
         return self.fetch("GET", uri, data, **options)
 
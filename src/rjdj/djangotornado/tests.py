@@ -51,6 +51,16 @@ def test_suite():
     optionflags = doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS
     testing = DocFileSuite('testing.txt', optionflags=optionflags)
     handlers = DocFileSuite('handlers.txt', optionflags=optionflags)
-    suite = unittest.TestSuite((testing,handlers,))
+    pool = DocFileSuite('pool.txt', optionflags=optionflags)
+    db = DocFileSuite('db.txt', optionflags=optionflags)
+    cache = DocFileSuite('cache.txt', optionflags=optionflags)
+    stats = DocFileSuite('stats.txt', optionflags=optionflags)
+    profiling = DocFileSuite('profiling.txt', optionflags=optionflags)
+    hub = DocFileSuite('hub.txt', optionflags=optionflags)
+    events = DocFileSuite('events.txt', optionflags=optionflags)
+    sessions = DocFileSuite('sessions.txt', optionflags=optionflags)
+    process = DocFileSuite('process.txt', optionflags=optionflags)
+    suite = unittest.TestSuite((testing,handlers,pool,db,cache,stats,profiling,hub,
+                                events,sessions,process,))
     suite.layer = CustomTestLayer
     return suite
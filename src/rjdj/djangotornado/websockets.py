@@ -0,0 +1,329 @@
+##############################################################################
+#
+# Copyright (c) 2011 Reality Jockey Ltd. and Contributors.
+# This file is part of django-tornado.
+#
+# Django-tornado is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Django-tornado is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with django-tornado. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+# -*- coding: utf-8 -*-
+
+__docformat__ = "reStructuredText"
+
+import json
+import time
+import struct
+import logging
+import functools
+
+from collections import deque
+
+import tornado
+
+from tornado.websocket import WebSocketHandler
+
+from django.core import signals
+
+from rjdj.djangotornado.pool import (get_worker_pool, WorkerPoolFull,
+                                     add_callback)
+from rjdj.djangotornado.db import (acquire_connections, release_connections,
+                                   ConnectionPoolTimeout)
+from rjdj.djangotornado.handlers import (DjangoRequest, middleware_provider,
+                                         request_io_loop)
+
+
+logger = logging.getLogger()
+
+DRAFT76 = "draft76"
+RFC6455 = "rfc6455"
+
+
+def encode_frame(message, binary=False):
+    """Encode an unmasked (server to client) RFC 6455 frame"""
+    opcode = 0x2 if binary else 0x1
+    length = len(message)
+    if length < 126:
+        header = struct.pack("BB", 0x80 | opcode, length)
+    elif length <= 0xFFFF:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + message
+
+def encode_draft76(message, binary=False):
+    """Encode a draft 76 frame (text only, binary raises ValueError)"""
+    if binary:
+        raise ValueError("Draft 76 WebSockets cannot send binary messages")
+    return "\x00" + message + "\xff"
+
+ENCODERS = {
+    RFC6455: encode_frame,
+    DRAFT76: encode_draft76,
+}
+
+def encode_message(message):
+    """Turn dicts into JSON and unicode into UTF-8"""
+    if isinstance(message, dict):
+        message = json.dumps(message)
+    if isinstance(message, unicode):
+        message = message.encode("utf-8")
+    return message
+
+def pending_bytes(stream):
+    """Number of bytes written to the stream but not sent yet"""
+    size = getattr(stream, "_write_buffer_size", None)
+    if size is not None:
+        return size
+    return sum(len(chunk) for chunk in getattr(stream, "_write_buffer", ()))
+
+
+class WebSocketGroup(object):
+    """A set of WebSockets receiving the same messages
+
+    `broadcast` encodes a message once per wire protocol and writes the
+    frame to every socket; it must be called on the IOLoop of the
+    sockets, other threads use `broadcast_threadsafe`.
+    """
+
+    def __init__(self):
+        self.sockets = set()
+        self.io_loop = None
+
+    def __len__(self):
+        return len(self.sockets)
+
+    def add(self, socket):
+        if self.io_loop is None:
+            self.io_loop = request_io_loop(socket.request)
+        self.sockets.add(socket)
+        socket._groups.add(self)
+
+    def discard(self, socket):
+        self.sockets.discard(socket)
+        socket._groups.discard(self)
+
+    def broadcast(self, message, binary=False):
+        """Send message to all sockets; returns the number of sockets
+
+        Binary messages raise ValueError if a socket of the group speaks
+        draft 76, before anything is sent.
+        """
+        message = encode_message(message)
+        frames = {}
+        sockets = list(self.sockets)
+        if binary and any(socket._protocol() == DRAFT76
+                          for socket in sockets):
+            raise ValueError("Draft 76 WebSockets cannot send binary messages")
+        for socket in sockets:
+            socket.send_encoded(message, frames, binary)
+        return len(sockets)
+
+    def broadcast_threadsafe(self, message, binary=False):
+        """Broadcast on the IOLoop of the sockets from any thread"""
+        if self.io_loop is not None:
+            add_callback(functools.partial(self.broadcast, message, binary),
+                         self.io_loop)
+
+
+class DjangoWebSocketHandler(WebSocketHandler):
+    """WebSocket handler with a Django request
+
+    When the socket opens, a `DjangoRequest` is built from the upgrade
+    request and the Django request middleware runs once in the worker
+    pool, so ``self.django_request`` carries the session and user.  If a
+    middleware answers the request itself (e.g. with a redirect to the
+    login page), or no worker or database connection is available, the
+    socket is closed.  Subclasses implement `on_open` (instead of
+    ``open``), ``on_message`` and ``on_close``; ``on_open`` runs on the
+    IOLoop and no frames are read before it returned.
+
+    Messages are sent with `send` or through a `WebSocketGroup`.  A
+    client which does not keep up gets at most ``max_pending_bytes``
+    queued in its stream, further messages go into a backlog of
+    ``max_backlog`` messages which is flushed as the client catches up;
+    once that is full, the client is dropped.  Both limits can be set
+    in the route kwargs.
+    """
+
+    max_pending_bytes = 1024 * 1024
+    max_backlog = 100
+    flush_interval = 0.05
+
+    def initialize(self, max_pending_bytes=None, max_backlog=None):
+        if max_pending_bytes is not None:
+            self.max_pending_bytes = max_pending_bytes
+        if max_backlog is not None:
+            self.max_backlog = max_backlog
+        self.django_request = None
+        self._groups = set()
+        self._backlog = deque()
+        self._flush_timeout = None
+        self._dropped = False
+        self._opening = False
+        self._read_pending = False
+
+    def open(self, *args, **kwargs):
+        self.django_request = DjangoRequest(self.request)
+        self._opening = True
+        future = None
+        if tornado.version_info >= (5, 1):
+            # Tornado reads no frames before the Future is resolved
+            from tornado.concurrent import Future
+            future = Future()
+        try:
+            get_worker_pool().submit(self._process_request, args, kwargs,
+                                     future)
+        except WorkerPoolFull:
+            logger.warning("No worker to open WebSocket %s",
+                           self.request.uri)
+            add_callback(functools.partial(self._opened, False, args, kwargs,
+                                           future),
+                         request_io_loop(self.request))
+        return future
+
+    def _process_request(self, args, kwargs, future):
+        """Run the request middleware in a worker thread"""
+        signals.request_started.send(sender=middleware_provider.__class__)
+        response = None
+        try:
+            acquire_connections()
+            try:
+                response = middleware_provider().process_request(
+                    self.django_request)
+            finally:
+                release_connections()
+            opened = response is None
+        except ConnectionPoolTimeout:
+            logger.warning("No database connection for WebSocket %s",
+                           self.request.uri)
+            opened = False
+        except Exception:
+            logger.error("Exception in middleware of WebSocket %s",
+                         self.request.uri, exc_info=True)
+            opened = False
+        add_callback(functools.partial(self._opened, opened, args, kwargs,
+                                       future),
+                     request_io_loop(self.request))
+
+    def _opened(self, opened, args, kwargs, future):
+        """Call on_open on the IOLoop and start reading frames"""
+        try:
+            if not opened:
+                self._drop()
+            elif not self._stream().closed():
+                self.async_callback(self.on_open)(*args, **kwargs)
+        finally:
+            signals.request_finished.send(
+                sender=middleware_provider.__class__)
+            self._opening = False
+            if future is not None:
+                future.set_result(None)
+            elif self._read_pending and not self._stream().closed():
+                self._read_pending = False
+                self._receive_message()
+
+    def _receive_message(self):
+        # Tornado 2.0 reads frames right after open(), we wait for on_open
+        if self._opening:
+            self._read_pending = True
+            return
+        super(DjangoWebSocketHandler, self)._receive_message()
+
+    def on_open(self, *args, **kwargs):
+        """Invoked once the socket is open and the middleware has run"""
+        pass
+
+    def send(self, message, binary=False):
+        """Send a message subject to the slow consumer limits"""
+        self.send_encoded(encode_message(message), {}, binary)
+
+    def _protocol(self):
+        connection = getattr(self, "ws_connection", None)
+        if connection is None:
+            # Tornado 2.0 only speaks draft 76
+            return DRAFT76
+        if connection.__class__.__name__ == "WebSocketProtocol76":
+            return DRAFT76
+        if getattr(connection, "_compressor", None) is not None:
+            # Compressed frames differ per connection
+            return None
+        return RFC6455
+
+    def _stream(self):
+        connection = getattr(self, "ws_connection", None)
+        return getattr(connection, "stream", None) or self.stream
+
+    def send_encoded(self, message, frames, binary=False):
+        """Send an encoded message, reusing the frames encoded already
+        for other sockets (a dict of protocol: frame)"""
+        if self._dropped:
+            return
+        protocol = self._protocol()
+        if binary and protocol == DRAFT76:
+            raise ValueError("Draft 76 WebSockets cannot send binary messages")
+        if protocol is None:
+            self.write_message(message, binary=binary)
+            return
+        frame = frames.get(protocol)
+        if frame is None:
+            frame = frames[protocol] = ENCODERS[protocol](message, binary)
+        self._send_frame(frame)
+
+    def _send_frame(self, frame):
+        stream = self._stream()
+        if stream.closed():
+            return
+        if self._backlog or pending_bytes(stream) > self.max_pending_bytes:
+            if len(self._backlog) >= self.max_backlog:
+                logger.warning("Dropping slow WebSocket client %s",
+                               self.request.remote_ip)
+                self._drop()
+                return
+            self._backlog.append(frame)
+            if self._flush_timeout is None:
+                self._schedule_flush()
+            return
+        stream.write(frame)
+
+    def _schedule_flush(self):
+        self._flush_timeout = request_io_loop(self.request).add_timeout(
+            time.time() + self.flush_interval, self._flush_backlog)
+
+    def _flush_backlog(self):
+        self._flush_timeout = None
+        stream = self._stream()
+        if stream.closed():
+            self._backlog.clear()
+            return
+        while self._backlog and \
+              pending_bytes(stream) <= self.max_pending_bytes:
+            stream.write(self._backlog.popleft())
+        if self._backlog:
+            self._schedule_flush()
+
+    def _drop(self):
+        """Close the connection right away"""
+        self._dropped = True
+        self._backlog.clear()
+        self._stream().close()
+
+    def on_connection_close(self):
+        for group in list(self._groups):
+            group.discard(self)
+        self._backlog.clear()
+        if self._flush_timeout is not None:
+            request_io_loop(self.request).remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+        super(DjangoWebSocketHandler, self).on_connection_close()